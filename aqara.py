@@ -6,65 +6,241 @@
 import socket
 import binascii
 import struct
-import json
+import asyncio
+import aqara_codec as codec
+import collections
+import threading
+import time
 import diffusion_server as DS
+from aqara_metrics import Metrics, PACKETS_BY_CMD_AND_MODEL
+from aqara_workers import shard_for
 import logging
 log = logging.getLogger(__name__)
 #logging.getLogger("diffusion_server").setLevel(logging.DEBUG)
 
 
 
+def _prepare_multicast_socket(address, port, bufsize):
+    """Create an UDP socket bound to ``port`` that joined the ``address`` multicast group"""
+    sock = socket.socket(socket.AF_INET,  # Internet
+                         socket.SOCK_DGRAM)  # UDP
+
+    sock.bind(("0.0.0.0", port))
+
+    mreq = struct.pack("=4sl", socket.inet_aton(address),
+                       socket.INADDR_ANY)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 32)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, bufsize)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+
+    return sock
+
+
+class DispatchPool:
+    """Handle raw packets in a pool of threads, keeping the order of packets of each ``sid``
+
+        :param handler: a function ``handler(message, addr)`` called from the pool threads
+        :param threads: (int) number of threads. Packets are sharded on their ``sid``:
+            packets of a device are always handled by the same thread, in arrival order
+        :param queue_size: (int) maximum number of packets waiting for each thread
+        :param policy: (str) what :meth:`put` does when the queue of a thread is full:
+            - ``"block"``: wait for room in the queue
+            - ``"drop_oldest"``: discard the oldest waiting packet of that queue
+            - ``"drop_newest"``: discard the packet being put
+
+        ``dropped`` counts discarded packets, ``processed`` handled ones, :meth:`depth`
+        gives the number of waiting packets and ``max_depth`` its high water mark.
+    """
+    POLICIES = ("block", "drop_oldest", "drop_newest")
+
+    def __init__(self, handler, threads=4, queue_size=1000, policy="block"):
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown policy %r not in %r"%(policy,self.POLICIES))
+        if int(threads) < 1 or int(queue_size) < 1:
+            raise ValueError("threads and queue_size should be positive numbers")
+        self.handler = handler
+        self.policy = policy
+        self.queue_size = int(queue_size)
+        self.queues = [collections.deque() for i in range(int(threads))]
+        self.conditions = [threading.Condition() for i in range(int(threads))]
+        self._dropped = [0] * int(threads)
+        self._processed = [0] * int(threads)
+        self.max_depth = 0
+        self._stopping = False
+        self.threads = [threading.Thread(target=self._run, args=(i,), name="dispatch_%d"%i)
+                        for i in range(int(threads))]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    @property
+    def dropped(self):
+        return sum(self._dropped)
+
+    @property
+    def processed(self):
+        return sum(self._processed)
+
+    def depth(self):
+        """Number of packets waiting to be handled"""
+        return sum(len(queue) for queue in self.queues)
+
+    def put(self, message, addr):
+        """Queue a raw packet for its ``sid`` thread"""
+        index = shard_for(codec.raw_sid(message), len(self.queues))
+        queue = self.queues[index]
+        condition = self.conditions[index]
+        with condition:
+            if len(queue) >= self.queue_size:
+                if self.policy == "drop_newest":
+                    self._dropped[index] += 1
+                    return False
+                elif self.policy == "drop_oldest":
+                    queue.popleft()
+                    self._dropped[index] += 1
+                else:
+                    while len(queue) >= self.queue_size and not self._stopping:
+                        condition.wait()
+            queue.append((message, addr))
+            condition.notify_all()
+        depth = self.depth()
+        if depth > self.max_depth:
+            self.max_depth = depth
+        return True
+
+    def _run(self, index):
+        queue = self.queues[index]
+        condition = self.conditions[index]
+        while True:
+            with condition:
+                while not queue and not self._stopping:
+                    condition.wait()
+                if not queue:
+                    return
+                message, addr = queue.popleft()
+                #wake up a blocked put
+                condition.notify_all()
+            try:
+                self.handler(message, addr)
+            except Exception:
+                log.exception("dispatch: error handling %r"%message)
+            self._processed[index] += 1
+
+    def stop(self, timeout=5):
+        """Handle the waiting packets and stop the threads"""
+        self._stopping = True
+        for condition in self.conditions:
+            with condition:
+                condition.notify_all()
+        for thread in self.threads:
+            thread.join(timeout)
+
+
 class AquaraConnector:
-    """Connector for the Xiaomi Mi Hub and devices on multicast."""
+    """Connector for the Xiaomi Mi Hub and devices on multicast.
+
+        :param data_callback: (opt) a function ``cb(address, kind, payload)`` called for each packet
+        :param start_server: (bool) forward every packet to the clients of a :class:`diffusion_server.DiffusionServer`
+        :param batch_callback: (opt) a function ``cb(packets)`` that enables the batch mode.
+            After the first blocking read, :meth:`check_incoming` drains every pending
+            datagram without blocking and calls ``batch_callback`` once with the list of
+            ``(address, kind, payload)`` tuples. ``data_callback`` is still called for each packet
+        :param rcvbuf_size: (int) size of the kernel receive buffer (``SO_RCVBUF``).
+            A large buffer absorbs heartbeat bursts between two reads
+        :param max_datagram_size: (int) maximum size of a single datagram
+        :param max_drain: (int) maximum number of datagrams given to ``batch_callback`` at once.
+            The remaining ones are read by the next drain, so a sustained flood can't keep
+            the connector draining forever
+        :param reactor: (opt) a :class:`reactor.Reactor`. The multicast socket, the diffusion
+            server and client are then all driven by this reactor instead of
+            :meth:`check_incoming` and their own threads, see :meth:`run_forever`
+        :param dispatch_threads: (int) when non zero, packets are decoded and given to
+            ``data_callback`` by a :class:`DispatchPool` of that many threads instead of
+            the receiving thread: a slow callback no longer delays the reads.
+            ``data_callback`` must then be thread safe. Not available in batch mode
+        :param dispatch_queue_size: (int) see :class:`DispatchPool` ``queue_size``
+        :param backpressure: (str) see :class:`DispatchPool` ``policy``
+        :param deduplicator: (opt) a :class:`aqara_devices.PacketDeduplicator`. Duplicate packets
+            are still relayed to the diffusion server but never given to the callbacks
+
+        :param latency_sample: (int) the decode and callback latencies are measured for one packet
+            in ``latency_sample``, ``0`` disables them (see :class:`aqara_metrics.Metrics`)
+
+        Ingest metrics (packets, decode and callback latencies, errors...) are returned by :meth:`stats`.
+
+        ``drain_counts`` counts how many drains returned a given number of datagrams
+        (``{datagrams: drains}``), ``last_drain_count`` holds the size of the last one.
+    """
 
     MULTICAST_PORT = 9898
     SERVER_PORT = 4321
 
     MULTICAST_ADDRESS = '224.0.0.50'
     SOCKET_BUFSIZE = 1024
+    RCVBUF_SIZE = 256 * 1024
+    MAX_DATAGRAM_SIZE = 4096
+    MAX_DRAIN = 256
 
-    def __init__(self, data_callback=None, start_server=False, auto_discover=True):
+    def __init__(self, data_callback=None, start_server=False, auto_discover=True,
+                 batch_callback=None, rcvbuf_size=RCVBUF_SIZE, max_datagram_size=MAX_DATAGRAM_SIZE,
+                 reactor=None, dispatch_threads=0, dispatch_queue_size=1000, backpressure="block",
+                 deduplicator=None, latency_sample=16, max_drain=MAX_DRAIN):
         """Initialize the connector."""
         self.data_callback = data_callback
+        self.batch_callback = batch_callback
+        self.rcvbuf_size = int(rcvbuf_size)
+        self.max_datagram_size = int(max_datagram_size)
+        self.max_drain = max(int(max_drain), 1)
+        self.drain_counts = collections.Counter()
+        self.last_drain_count = 0
         self.last_tokens = dict()
+        self.reactor = reactor
+        self.deduplicator = deduplicator
+        self.metrics = Metrics(latency_sample=latency_sample)
+        self._decode_latency = self.metrics.histogram("decode")
+        self._callback_latency = self.metrics.histogram("callback")
+        self._last_stats = (time.time(), 0)
+        self.pool = None
+        if dispatch_threads:
+            if batch_callback is not None:
+                raise ValueError("dispatch_threads can't be used with a batch_callback")
+            self.pool = DispatchPool(self.__handle_message, threads=dispatch_threads,
+                                     queue_size=dispatch_queue_size, policy=backpressure)
         self.client = None
         try:
             self.socket = self._prepare_socket()
-        except:
+        except Exception as e:
             self.socket = None
-            log.warning("Unable to bind socket (%r), trying client instead")
-            self.client = DS.DiffusionClient(self.__data_callback,"localhost")
+            log.warning("Unable to bind socket (%r), trying client instead"%e)
+            self.client = DS.DiffusionClient(self.__data_callback,"localhost",reactor=reactor)
+
+        if self.socket is not None and self.reactor is not None:
+            self.reactor.register(self.socket, self.__on_readable)
 
         self.server = None
         if start_server:
-           self.server = DS.DiffusionServer()
+           self.server = DS.DiffusionServer(reactor=reactor)
+
+        self.metrics.gauge("drain_counts", lambda: dict(self.drain_counts))
+        if self.pool is not None:
+            self.metrics.gauge("dispatch_depth", self.pool.depth)
+            self.metrics.gauge("dispatch_max_depth", lambda: self.pool.max_depth)
+            self.metrics.gauge("dispatch_dropped", lambda: self.pool.dropped)
+        if self.deduplicator is not None:
+            self.metrics.gauge("dedupe", self.deduplicator.stats)
+        if self.server is not None:
+            self.metrics.gauge("diffusion_clients", lambda: len(self.server.active_connections))
 
     def __enter__(self):
         return self
     def __exit__(self, exception_type, exception_value, traceback):
-        if self.server is not None:
-            self.server.stop()
-        if self.client is not None:
-            self.client.stop()
+        self.stop()
 
     def _prepare_socket(self):
-        sock = socket.socket(socket.AF_INET,  # Internet
-                             socket.SOCK_DGRAM)  # UDP
-
-        sock.bind(("0.0.0.0", self.MULTICAST_PORT))
+        return _prepare_multicast_socket(self.MULTICAST_ADDRESS, self.MULTICAST_PORT, self.rcvbuf_size)
 
-        mreq = struct.pack("=4sl", socket.inet_aton(self.MULTICAST_ADDRESS),
-                           socket.INADDR_ANY)
-        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 32)
-        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
-                        self.SOCKET_BUFSIZE)
-        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
-
-        return sock
-
-    def __data_callback(self,message,addr):
-        log.debug("received message %r"%message)
+    def __forward(self,message):
         if self.server is not None:
             try:
                 log.debug("sending message to clients")
@@ -73,28 +249,174 @@ class AquaraConnector:
             except:
                 log.exception("send")
                 pass
+
+    def __data_callback(self,message,addr):
+        log.debug("received message %r", message)
+        self.metrics.counters["received"] += 1
+        self.metrics.counters["received_bytes"] += len(message)
+        self.__forward(message)
+        if self.pool is not None:
+            self.pool.put(message, addr)
+        else:
+            self.__handle_message(message, addr)
+
+    def __decode(self,message,timed):
+        """decode a packet and account for it in the metrics, its latency if ``timed``"""
+        counters = self.metrics.counters
+        if timed:
+            start = time.perf_counter_ns()
+        try:
+            payload = codec.decode_packet(message)
+        except ValueError:
+            counters["decode_errors"] += 1
+            raise
+        if timed:
+            self._decode_latency.observe(time.perf_counter_ns() - start)
+        counters[(PACKETS_BY_CMD_AND_MODEL, (payload.get("cmd"), payload.get("model")))] += 1
+        if self.deduplicator is not None and self.deduplicator.is_duplicate(payload):
+            counters["duplicates"] += 1
+            return None
+        return payload
+
+    def __call_back(self,timed,callback,*args):
+        """call a user callback and account for it in the metrics, its latency if ``timed``"""
+        if not timed:
+            try:
+                callback(*args)
+            except Exception:
+                self.metrics.counters["callback_errors"] += 1
+                raise
+            return
+        start = time.perf_counter_ns()
+        try:
+            callback(*args)
+        except Exception:
+            self.metrics.counters["callback_errors"] += 1
+            raise
+        finally:
+            self._callback_latency.observe(time.perf_counter_ns() - start)
+
+    def __handle_message(self,message,addr):
         if self.data_callback is not None:
-            payload = json.loads(message.decode("utf-8"))
+            #a single sampling decision per packet, for both latencies
+            timed = self.metrics.sample()
+            payload = self.__decode(message, timed)
+            if payload is None:
+                return
             log.debug("Calling callback")
-            self.data_callback(addr[0], 'aquara', payload)
+            self.__call_back(timed, self.data_callback, addr[0], 'aquara', payload)
+
+    def __batch_callback(self,datagrams):
+        packets = []
+        counters = self.metrics.counters
+        for message, addr in datagrams:
+            counters["received"] += 1
+            counters["received_bytes"] += len(message)
+            self.__forward(message)
+            timed = self.metrics.sample()
+            #a bad packet or a failing callback must not lose the rest of the drain
+            try:
+                payload = self.__decode(message, timed)
+            except ValueError:
+                log.error("Can't decode message %r"%message)
+                continue
+            except Exception:
+                counters["decode_errors"] += 1
+                log.exception("Can't decode message %r"%message)
+                continue
+            if payload is None:
+                continue
+            if self.data_callback is not None:
+                try:
+                    self.__call_back(timed, self.data_callback, addr[0], 'aquara', payload)
+                except Exception:
+                    log.exception("data_callback failed on %r"%(payload,))
+            packets.append((addr[0], 'aquara', payload))
+        #once per drain: always timed
+        self.__call_back(True, self.batch_callback, packets)
+
+    def _drain(self, limit):
+        """Read the pending datagrams (at most ``limit``) without blocking"""
+        datagrams = []
+        while len(datagrams) < limit:
+            try:
+                datagrams.append(self.socket.recvfrom(self.max_datagram_size, socket.MSG_DONTWAIT))
+            except (BlockingIOError, InterruptedError):
+                return datagrams
+        self.metrics.counters["capped_drains"] += 1
+        return datagrams
+
+    def stats(self):
+        """Returns the ingest metrics
+
+            a dict (see :meth:`aqara_metrics.Metrics.snapshot`) with:
+                - ``counters``: ``received``, ``received_bytes``, ``decode_errors``, ``duplicates``,
+                  ``callback_errors``, ``capped_drains`` (see ``max_drain``), ``packets_by_cmd``
+                  and ``packets_by_model``
+                - ``latencies``: ``decode`` and ``callback`` (per packet, in ns)
+                - ``gauges``: ``drain_counts``, the dispatch pool and deduplicator state
+                - ``packets_per_s``: received packets per second since the previous call
+        """
+        stats = self.metrics.snapshot()
+        now = time.time()
+        received = self.metrics.counters["received"]
+        last_time, last_received = self._last_stats
+        stats["packets_per_s"] = (received - last_received) / max(now - last_time, 1e-9)
+        self._last_stats = (now, received)
+        return stats
 
     def stop(self):
+        if self.socket is not None and self.reactor is not None:
+            self.reactor.unregister(self.socket)
+        if self.pool is not None:
+            self.pool.stop()
         if self.server is not None:
             self.server.stop()
         if self.client is not None:
             self.client.stop()
 
+    def _receive(self, flags=0):
+        """Read one datagram (and drain pending ones in batch mode) and handle it"""
+        data, addr = self.socket.recvfrom(self.max_datagram_size, flags)
+        if self.batch_callback is not None:
+            datagrams = [(data, addr)] + self._drain(self.max_drain - 1)
+            self.last_drain_count = len(datagrams)
+            self.drain_counts[self.last_drain_count] += 1
+            self.__batch_callback(datagrams)
+        else:
+            try:
+                #print('Aquara received from ' + addr[0] + ' : ' + data)
+                self.__data_callback(data,addr)
+            except Exception as e:
+                raise
+                print("Can't handle message %r (%r)" % (data, e))
+
+    def __on_readable(self, sock, mask):
+        try:
+            self._receive(socket.MSG_DONTWAIT)
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def run_forever(self, timeout=None):
+        """Run the reactor given to the constructor until it is stopped
+
+            :param timeout: (opt) return after ``timeout`` seconds
+            :raises: :exc:`RuntimeError`: the connector was created without reactor,
+                or the exceptions raised by the diffusion server or client
+        """
+        if self.reactor is None:
+            raise RuntimeError("run_forever needs a connector created with a reactor")
+        self.reactor.run_forever(timeout)
+        if self.server is not None:
+            self.server.check_and_raise()
+        if self.client is not None:
+            self.client.check_and_raise()
+
     def check_incoming(self):
         """Check incoming data."""
         try:
             if self.socket is not None:
-                data, addr = self.socket.recvfrom(self.SOCKET_BUFSIZE)
-                try:
-                    #print('Aquara received from ' + addr[0] + ' : ' + data)
-                    self.__data_callback(data,addr)
-                except Exception as e:
-                    raise
-                    print("Can't handle message %r (%r)" % (data, e))
+                self._receive()
 
             if self.server is not None:
                 self.server.check_and_raise()
@@ -108,8 +430,137 @@ class AquaraConnector:
     def send_command(self, data, addr = MULTICAST_ADDRESS, port=MULTICAST_PORT):
         """Send a command to the UDP subject (all related will answer)."""
         if type(data) is dict:
-            self.socket.sendto(json.dumps(data).encode("utf-8"), (addr, port))
+            self.socket.sendto(codec.dumpb(data), (addr, port))
         else:
             self.socket.sendto(data.encode("utf-8"), (addr, port))
-                                                            
 
+
+class _AquaraDatagramProtocol(asyncio.DatagramProtocol):
+    """asyncio protocol feeding datagrams to an :class:`AsyncAquaraConnector`"""
+    def __init__(self, connector):
+        self.connector = connector
+
+    def datagram_received(self, data, addr):
+        self.connector._on_datagram(data, addr)
+
+    def error_received(self, exc):
+        log.error("Multicast socket error: %r"%exc)
+
+    def connection_lost(self, exc):
+        self.connector._on_connection_lost(exc)
+
+
+class AsyncAquaraConnector:
+    """asyncio connector for the Xiaomi Mi Hub and devices on multicast.
+
+        :param data_callback: (opt) a function ``cb(address, kind, payload)``
+            called from the event loop for each packet. When it is ``None``,
+            decoded packets are queued and can be read with ``async for``
+        :param start_server: (bool) run a :class:`diffusion_server.AsyncDiffusionServer`
+            in the same event loop and forward every packet to its clients
+        :param queue_size: (int) maximum number of packets waiting to be read
+            by ``async for`` (0: unbounded). Packets received while the queue is
+            full are dropped and counted in ``dropped_packets``
+
+        Usage::
+
+            async with AsyncAquaraConnector() as connector:
+                async for packet in connector:
+                    root.handle_packet(packet)
+
+        Several connectors and servers can share one event loop, no thread is used.
+    """
+
+    MULTICAST_PORT = AquaraConnector.MULTICAST_PORT
+    MULTICAST_ADDRESS = AquaraConnector.MULTICAST_ADDRESS
+    RCVBUF_SIZE = AquaraConnector.RCVBUF_SIZE
+
+    def __init__(self, data_callback=None, start_server=False, queue_size=1024):
+        self.data_callback = data_callback
+        self.start_server = start_server
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.dropped_packets = 0
+        self.transport = None
+        self.server = None
+        self._stopped = False
+
+    async def start(self):
+        """Bind the multicast socket (and the diffusion server) in the running loop"""
+        loop = asyncio.get_running_loop()
+        sock = _prepare_multicast_socket(self.MULTICAST_ADDRESS, self.MULTICAST_PORT, self.RCVBUF_SIZE)
+        self.transport, _ = await loop.create_datagram_endpoint(lambda: _AquaraDatagramProtocol(self), sock=sock)
+        if self.start_server:
+            self.server = DS.AsyncDiffusionServer()
+            await self.server.start()
+        return self
+
+    def stop(self):
+        """Close the socket and the server, pending ``async for`` loops terminate"""
+        if self._stopped:
+            return
+        self._stopped = True
+        if self.transport is not None:
+            self.transport.close()
+        if self.server is not None:
+            self.server.stop()
+        self._wake_readers()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, exception_type, exception_value, traceback):
+        self.stop()
+        if self.server is not None:
+            await self.server.wait_closed()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._stopped and self.queue.empty():
+            raise StopAsyncIteration
+        packet = await self.queue.get()
+        if packet is None:
+            raise StopAsyncIteration
+        return packet
+
+    def _wake_readers(self):
+        try:
+            self.queue.put_nowait(None)
+        except asyncio.QueueFull:
+            pass
+
+    def _on_datagram(self, message, addr):
+        log.debug("received message %r", message)
+        if self.server is not None:
+            try:
+                self.server.send_message(message)
+            except:
+                log.exception("send")
+        try:
+            payload = codec.decode_packet(message)
+        except ValueError:
+            log.error("Can't decode message %r"%message)
+            return
+        if self.data_callback is not None:
+            self.data_callback(addr[0], 'aquara', payload)
+            return
+        try:
+            self.queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            self.dropped_packets += 1
+            log.warning("packet queue full, dropping packet (%d dropped)"%self.dropped_packets)
+
+    def _on_connection_lost(self, exc):
+        if exc is not None:
+            log.error("Multicast socket closed: %r"%exc)
+        self._stopped = True
+        self._wake_readers()
+
+    async def send_command(self, data, addr = MULTICAST_ADDRESS, port=MULTICAST_PORT):
+        """Send a command to the UDP subject (all related will answer)."""
+        if type(data) is dict:
+            data = codec.dumps(data)
+        self.transport.sendto(data.encode("utf-8"), (addr, port))
+        #give the loop a chance to flush the datagram
+        await asyncio.sleep(0)
@@ -0,0 +1,148 @@
+""" JSON codec for aqara packets
+
+    Uses the fastest installed backend (``orjson``, then ``ujson``) and falls
+    back to the standard :mod:`json` module. Run this module to compare the
+    decoding speed of the available backends::
+
+        python aqara_codec.py
+"""
+import sys
+import re
+import json
+import time
+import logging
+log = logging.getLogger(__name__)
+
+BACKENDS = ("orjson", "ujson", "json")
+
+def _load_backend(name):
+    """returns (loads, dumpb) for backend ``name``, raises :exc:`ImportError` if it is not installed"""
+    if name == "orjson":
+        import orjson
+        return orjson.loads, orjson.dumps
+    elif name == "ujson":
+        import ujson
+        def ujson_dumpb(obj):
+            return ujson.dumps(obj, ensure_ascii=False).encode("utf-8")
+        return ujson.loads, ujson_dumpb
+    elif name == "json":
+        def json_dumpb(obj):
+            return json.dumps(obj).encode("utf-8")
+        return json.loads, json_dumpb
+    raise ValueError("Unknown backend %r not in %r"%(name, BACKENDS))
+
+def available_backends():
+    """returns the list of installed backends, fastest first"""
+    backends = []
+    for name in BACKENDS:
+        try:
+            _load_backend(name)
+            backends.append(name)
+        except ImportError:
+            pass
+    return backends
+
+def use_backend(name):
+    """Select the backend used by this module
+
+        :param name: one of :data:`BACKENDS`
+        :raises: :exc:`ImportError`: the backend is not installed
+    """
+    global backend, _loads, _dumpb
+    _loads, _dumpb = _load_backend(name)
+    backend = name
+    log.debug("using %s codec"%name)
+
+use_backend(available_backends()[0])
+
+def loads(data):
+    """Decode a json ``bytes`` or ``str``
+
+        :raises: :exc:`ValueError` (invalid json)
+    """
+    return _loads(data)
+
+def dumpb(obj):
+    """Encode ``obj`` to json ``bytes``"""
+    return _dumpb(obj)
+
+def dumps(obj):
+    """Encode ``obj`` to a json ``str``"""
+    return _dumpb(obj).decode("utf-8")
+
+_intern = sys.intern
+_INTERNED_FIELDS = ("cmd", "model", "sid")
+
+def decode_packet(message):
+    """Decode a raw aqara packet (``bytes`` or ``str``)
+
+        the nested ``data`` json string is decoded in the same pass, so the returned
+        packet ``data`` field is a dict. The ``cmd``, ``model`` and ``sid`` values and
+        the ``data`` keys (capability names) are interned: every packet of a device
+        shares the same string objects.
+
+        :raises: :exc:`ValueError` (invalid json, or json that is not an object)
+    """
+    packet = _loads(message)
+    if type(packet) is not dict:
+        raise ValueError("Not an aqara packet: %r"%(message,))
+    for field in _INTERNED_FIELDS:
+        value = packet.get(field)
+        if type(value) is str:
+            packet[field] = _intern(value)
+    data = packet.get("data")
+    if type(data) is str:
+        try:
+            data = _loads(data)
+        except ValueError:
+            #keep the raw string, AqaraRoot will report it
+            return packet
+        if type(data) is dict:
+            data = {_intern(key): value for key, value in data.items()}
+        packet["data"] = data
+    return packet
+
+_SID_RE = re.compile(br'"sid"\s*:\s*"([^"]*)"')
+_CMD_RE = re.compile(br'"cmd"\s*:\s*"([^"]*)"')
+
+def raw_sid(message):
+    """Extract the sid of a raw packet (``bytes``) without decoding it (``b""`` if there is none)"""
+    match = _SID_RE.search(message)
+    if match is None:
+        return b""
+    return match.group(1)
+
+def raw_cmd(message):
+    """Extract the cmd of a raw packet (``bytes``) without decoding it (``b""`` if there is none)"""
+    match = _CMD_RE.search(message)
+    if match is None:
+        return b""
+    return match.group(1)
+
+#################################################################################################################
+_SAMPLE_PACKETS = [
+    {"cmd":"report","model":"weather.v2","sid":"158d0001a2b3c4","short_id":40553,"data":"{\"temperature\":\"2137\"}"},
+    {"cmd":"heartbeat","model":"weather.v2","sid":"158d0001a2b3c4","short_id":40553,"data":"{\"voltage\":3005,\"temperature\":\"2137\",\"humidity\":\"4512\",\"pressure\":\"98755\"}"},
+    {"cmd":"report","model":"sensor_magnet.aq2","sid":"158d0001d5e6f7","short_id":2112,"data":"{\"status\":\"open\"}"},
+    {"cmd":"heartbeat","model":"gateway","sid":"7811dcb2a1c0","short_id":"0","token":"a1B2c3D4e5F6g7H8","data":"{\"ip\":\"192.168.0.20\"}"},
+    {"cmd":"report","model":"sensor_motion.aq2","sid":"158d0001f8a9b0","short_id":7345,"data":"{\"lux\":\"112\"}"},
+]
+
+def benchmark(name, iterations=20000):
+    """returns the number of packets decoded per second by :func:`decode_packet` with backend ``name``"""
+    previous = backend
+    use_backend(name)
+    try:
+        messages = [json.dumps(packet).encode("utf-8") for packet in _SAMPLE_PACKETS]
+        start = time.perf_counter()
+        for i in range(iterations):
+            for message in messages:
+                decode_packet(message)
+        elapsed = time.perf_counter() - start
+    finally:
+        use_backend(previous)
+    return iterations * len(messages) / elapsed
+
+if __name__ == "__main__":
+    for name in available_backends():
+        print("%-8s %10.0f packets/s"%(name, benchmark(name)))
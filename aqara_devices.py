@@ -2,18 +2,46 @@
 """ Aqara device """
 from __future__ import unicode_literals
 import json
+import collections
+import aqara_codec as codec
+from aqara_metrics import Metrics, PACKETS_BY_CMD_AND_MODEL
+import threading
+import concurrent.futures
+import time
+import binascii
 import logging
 log=logging.getLogger(__name__)
 
+try:
+    from collections.abc import Mapping
+except ImportError:
+    #python 2
+    from collections import Mapping
+
+try:
+    from Crypto.Cipher import AES
+except ImportError:
+    #commands can't be sent to the gateway without pycryptodome
+    AES = None
+
+try:
+    import numpy
+except ImportError:
+    #NumericData columnar history is not available without numpy
+    numpy = None
+
 #################################################################################################################
 class KnownDevices:
     """Handle known devices : gives a context to **sid**
     
         :param known_devices_file: (str) name of file that contains informations about sids
+        :param read_only: (bool) never write the file: unknown sids are only added in memory.
+            Use it when another process owns the file (see :class:`aqara_workers.ShardedDispatcher`)
 
     """
-    def __init__(self,known_devices_file = "known_devices.json"):
+    def __init__(self,known_devices_file = "known_devices.json", read_only = False):
         self.known_devices_file = known_devices_file
+        self.read_only = read_only
         self.__load_known_devices()
 
     def __load_known_devices(self):
@@ -50,7 +78,7 @@ class KnownDevices:
         returns a dict(room = "Room", name = "Name", model = "Model")
 
         if data is a packet and data["sid"] is not known, room, name will be ""
-        and the sid will be appended to the json file
+        and the sid will be appended to the json file (unless ``read_only``)
 
         if data is a string (sid): the device won't be appended
         """
@@ -66,15 +94,86 @@ class KnownDevices:
             sid = data["sid"]
             device_info = self.known_devices.get(sid)
             if device_info is None:
-                log.info("No context for device with sid: %s. Added to %s"%(sid,self.known_devices_file))
                 self.known_devices[sid] = dict(room = "", name = "", model = data["model"])
-                self.__save_known_devices()
+                if self.read_only:
+                    log.info("No context for device with sid: %s"%sid)
+                else:
+                    log.info("No context for device with sid: %s. Added to %s"%(sid,self.known_devices_file))
+                    self.__save_known_devices()
             return self.known_devices[sid]
         except KeyError:
             #import pdb ;  pdb.set_trace()
             log.error("get_infos: Invalid packet %r"%data)
             raise
 
+#################################################################################################################
+def _data_key(data):
+    """hashable form of the ``data`` field of a packet (raw json string or decoded dict)
+
+        a raw json string is decoded first: both forms of the same data give the same key
+    """
+    if isinstance(data, (str, bytes)):
+        try:
+            data = codec.loads(data)
+        except ValueError:
+            return data
+    if isinstance(data, dict):
+        try:
+            return tuple(sorted(data.items()))
+        except TypeError:
+            return json.dumps(data, sort_keys=True)
+    return data
+
+class PacketDeduplicator(object):
+    """Detect packets that were already received
+
+        :param ttl: (float) a packet is a duplicate when it carries the same ``data`` as the
+            latest packet of the same ``sid`` and ``cmd``, received less than ``ttl`` seconds ago
+        :param max_entries: (int) maximum number of ``(sid, cmd)`` remembered. The least
+            recently seen are forgotten first
+        :param cmds: the ``cmd`` values that can be suppressed
+
+        Only the latest packet of each ``(sid, cmd)`` is compared, so a state that comes back
+        (``open``, ``close``, ``open``) is never suppressed. Keep ``ttl`` below the time between
+        two intentional identical reports (a double ``click`` on a switch sends two identical packets).
+
+        ``received`` counts the packets checked and ``suppressed`` the duplicates found.
+    """
+    def __init__(self, ttl=1.0, max_entries=1024, cmds=("heartbeat","report")):
+        self.ttl = float(ttl)
+        self.max_entries = int(max_entries)
+        self.cmds = cmds
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.received = 0
+        self.suppressed = 0
+
+    def is_duplicate(self, packet, now=None):
+        """``True`` if ``packet`` (a dict whose ``data`` is raw or decoded) is a duplicate"""
+        cmd = packet.get("cmd")
+        if cmd not in self.cmds:
+            return False
+        if now is None:
+            now = time.time()
+        key = (packet.get("sid"), cmd)
+        data = _data_key(packet.get("data"))
+        with self.lock:
+            self.received += 1
+            last = self.entries.get(key)
+            if last is not None and last[0] == data and now - last[1] < self.ttl:
+                self.suppressed += 1
+                self.entries.move_to_end(key)
+                return True
+            self.entries[key] = (data, now)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return False
+
+    def stats(self):
+        """returns a dict with the ``received``, ``suppressed`` and ``entries`` counters"""
+        return {"received": self.received, "suppressed": self.suppressed, "entries": len(self.entries)}
+
 #################################################################################################################
 class CallbackHandler(object):
     """A generic class to handle registering and unregistering to _events_
@@ -193,25 +292,349 @@ class CallbackHandler(object):
 
 import time
 
+class RingBuffer(object):
+    """Fixed capacity sequence of the newest items
+
+        :param capacity: (int) maximum number of items
+
+        :meth:`append` costs O(1) whatever the capacity: once the buffer is full, the oldest
+        item is overwritten. ``ring[0]`` is the newest item and ``ring[-1]`` the oldest one,
+        iteration goes from the newest to the oldest.
+    """
+    __slots__ = ("items", "capacity", "head", "count", "appended")
+
+    def __init__(self, capacity):
+        self.capacity = int(capacity)
+        self.items = [None] * self.capacity
+        self.head = -1  #position of the newest item
+        self.count = 0
+        self.appended = 0  #number of items ever appended
+
+    def append(self, item):
+        self.appended += 1
+        if self.capacity == 0:
+            return
+        self.head += 1
+        if self.head == self.capacity:
+            self.head = 0
+        self.items[self.head] = item
+        if self.count < self.capacity:
+            self.count += 1
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("RingBuffer index out of range")
+        return self.items[(self.head - index) % self.capacity]
+
+    def __iter__(self):
+        return self.iter_newest()
+
+    def iter_newest(self, count=None):
+        """iterate over the ``count`` newest items (all of them when ``None``), newest first"""
+        items = self.items
+        capacity = self.capacity
+        head = self.head
+        for index in range(self.count if count is None else min(count, self.count)):
+            yield items[(head - index) % capacity]
+
+    def view(self, start, stop):
+        """a :class:`RingView` of the items ``ring[start:stop]``"""
+        start = max(0, min(start, self.count))
+        stop = max(start, min(stop, self.count))
+        return RingView(self, self.appended - 1 - start, stop - start)
+
+    def get_appended(self, number):
+        """the item appended in ``number`` th position (0 for the first one)
+
+            :raises: :exc:`IndexError` (the item was overwritten or is not appended yet)
+        """
+        index = self.appended - 1 - number
+        if index < 0:
+            raise IndexError("RingBuffer item not appended yet")
+        return self[index]
+
+class RingView(object):
+    """A read-only range of a :class:`RingBuffer`, newest item first like the buffer
+
+        the view does not copy the items: it keeps showing the same items when new ones are
+        appended to the buffer, and raises :exc:`IndexError` for the items overwritten since.
+        ``reversed(view)`` goes from the oldest to the newest item.
+    """
+    __slots__ = ("ring", "newest", "length")
+
+    def __init__(self, ring, newest, length):
+        self.ring = ring
+        self.newest = newest  #append number of the newest item
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("RingView index out of range")
+        return self.ring.get_appended(self.newest - index)
+
+    def __iter__(self):
+        for index in range(self.length):
+            yield self[index]
+
+    def __reversed__(self):
+        for index in range(self.length - 1, -1, -1):
+            yield self[index]
+
+class NumericColumns(object):
+    """Columnar history of a :class:`NumericData`, see :meth:`NumericData.enable_columns`
+
+        :param capacity: (int) number of samples kept
+        :raises: :exc:`ImportError` (numpy is not installed), :exc:`ValueError` (bad capacity)
+
+        The timestamps and values are stored in preallocated ``float64`` arrays. Every sample
+        is written twice, at ``i`` and ``i + capacity`` of arrays twice as long: the last
+        samples are always a contiguous slice, so the queries work on views of the arrays and
+        never copy the history.
+
+        The queries take a window: the ``last`` samples and/or the samples of the last
+        ``seconds`` before ``now`` (default ``time.time()``), the whole history by default.
+        They return ``None`` when the window is empty.
+    """
+    def __init__(self, capacity):
+        if numpy is None:
+            raise ImportError("numpy is required for the columnar history")
+        self.capacity = int(capacity)
+        if self.capacity <= 0:
+            raise ValueError("capacity should be a strictly positive number, %r given"%capacity)
+        self.times = numpy.empty(2 * self.capacity)
+        self.values = numpy.empty(2 * self.capacity)
+        self.next = 0  #position of the next sample
+        self.count = 0
+
+    def append(self, timestamp, value):
+        position = self.next
+        self.times[position] = self.times[position + self.capacity] = timestamp
+        self.values[position] = self.values[position + self.capacity] = value
+        position += 1
+        self.next = 0 if position == self.capacity else position
+        if self.count < self.capacity:
+            self.count += 1
+
+    def __len__(self):
+        return self.count
+
+    def window(self, last=None, seconds=None, now=None):
+        """returns the ``(times, values)`` arrays of the window, oldest sample first
+
+            the arrays are views: they are overwritten by the next samples
+        """
+        end = self.next + self.capacity
+        start = end - (self.count if last is None else max(0, min(int(last), self.count)))
+        if seconds is not None:
+            if now is None:
+                now = time.time()
+            start += int(numpy.searchsorted(self.times[start:end], now - seconds))
+        return self.times[start:end], self.values[start:end]
+
+    def mean(self, last=None, seconds=None, now=None):
+        values = self.window(last, seconds, now)[1]
+        return float(values.mean()) if len(values) else None
+
+    def min(self, last=None, seconds=None, now=None):
+        values = self.window(last, seconds, now)[1]
+        return float(values.min()) if len(values) else None
+
+    def max(self, last=None, seconds=None, now=None):
+        values = self.window(last, seconds, now)[1]
+        return float(values.max()) if len(values) else None
+
+    def percentile(self, q, last=None, seconds=None, now=None):
+        """the ``q`` th percentile (``q`` in [0, 100]) of the values"""
+        values = self.window(last, seconds, now)[1]
+        return float(numpy.percentile(values, q)) if len(values) else None
+
+    def rate(self, last=None, seconds=None, now=None):
+        """the change of the value per second between the first and the last sample of the
+            window, ``None`` if there is less than two samples
+        """
+        times, values = self.window(last, seconds, now)
+        if len(values) < 2 or times[-1] == times[0]:
+            return None
+        return float((values[-1] - values[0]) / (times[-1] - times[0]))
+
+    def between(self, t0, t1):
+        """returns the ``(times, values)`` views of the samples with ``t0 <= time < t1``"""
+        end = self.next + self.capacity
+        start = end - self.count
+        first, last = numpy.searchsorted(self.times[start:end], (t0, t1))
+        return self.times[start + first:start + last], self.values[start + first:start + last]
+
+def _count_newer(ring, field, timestamp, inclusive):
+    """number of items of ``ring`` newer than ``timestamp`` (or at ``timestamp`` if ``inclusive``)
+
+        binary search on the ``field`` attribute of the items, which decreases with the index
+    """
+    low, high = 0, len(ring)
+    while low < high:
+        middle = (low + high) // 2
+        item_time = getattr(ring[middle], field)
+        if item_time > timestamp or (inclusive and item_time == timestamp):
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+class RollupBucket(object):
+    """The aggregate of the values of a :class:`RollupTier` received during ``period`` seconds
+        from ``start_time``: their ``count``, ``sum``, ``min``, ``max`` and ``last`` value
+    """
+    __slots__ = ("start_time", "count", "sum", "min", "max", "last")
+
+    def __init__(self, start_time, value):
+        self.start_time = start_time
+        self.count = 1
+        self.sum = self.min = self.max = self.last = value
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        elif value > self.max:
+            self.max = value
+        self.last = value
+
+    @property
+    def mean(self):
+        return self.sum / self.count
+
+    def __repr__(self):
+        return "RollupBucket(start_time=%r, count=%r, sum=%r, min=%r, max=%r, last=%r)"%(
+                self.start_time, self.count, self.sum, self.min, self.max, self.last)
+
+class RollupTier(object):
+    """Values of a :class:`NumericData` aggregated in buckets of ``period`` seconds
+
+        :param period: (float) duration of a bucket in seconds, buckets start at a multiple of it
+        :param retention: (int) number of buckets kept
+        :raises: :exc:`ValueError` (bad period or retention)
+
+        ``buckets`` is a :class:`RingBuffer` of :class:`RollupBucket`, newest first. Only the
+        periods with values have a bucket. A value older than the newest bucket (the clock went
+        backwards) is added to the newest bucket.
+    """
+    def __init__(self, period, retention):
+        self.period = period
+        if not period > 0:
+            raise ValueError("rollup period should be a strictly positive number, %r given"%period)
+        if int(retention) <= 0:
+            raise ValueError("rollup retention should be a strictly positive number, %r given"%retention)
+        self.buckets = RingBuffer(retention)
+        self.current = None
+
+    def add(self, timestamp, value):
+        start_time = timestamp - timestamp % self.period
+        current = self.current
+        if current is not None and start_time <= current.start_time:
+            current.add(value)
+        else:
+            self.current = RollupBucket(start_time, value)
+            self.buckets.append(self.current)
+
+    def get_range(self, t0, t1):
+        """the buckets that start between ``t0`` (included) and ``t1`` (excluded), as a
+            :class:`RingView` (newest first, see :meth:`Data.get_range`)
+        """
+        return self.buckets.view(_count_newer(self.buckets, "start_time", t1, True),
+                                 _count_newer(self.buckets, "start_time", t0, True))
+
+class Measurement(Mapping):
+    """A measurement of a :class:`Data`, see :meth:`Data.get_measurement`
+
+        Only the time and the values are stored per measurement, the other fields are
+        read from the :class:`Data`. A measurement is a read-only mapping with the keys
+        of :attr:`FIELDS` (``dict(measurement)`` gives a ``dict`` copy), every field is
+        also an attribute.
+    """
+    __slots__ = ("data", "update_time", "raw_value", "value")
+    FIELDS = ("source_device", "data_type", "data_units", "update_time", "raw_value", "value")
+
+    def __init__(self, data, update_time, raw_value):
+        self.data = data
+        self.update_time = update_time
+        self.raw_value = raw_value
+        self.value = raw_value
+
+    @property
+    def source_device(self):
+        return self.data.device
+
+    @property
+    def data_type(self):
+        return self.data.quantity_name
+
+    @property
+    def data_units(self):
+        return self.data.units
+
+    def __getitem__(self, key):
+        if key in self.FIELDS:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self.FIELDS)
+
+    def __len__(self):
+        return len(self.FIELDS)
+
+    def __repr__(self):
+        return "%s(%r)"%(self.__class__.__name__, dict(self))
+
+def _vrgb(raw_value):
+    val = int(raw_value)
+    return ((val >> 24) & 0xff, (val >> 16) & 0xff, (val >> 8) & 0xff, val & 0xff)
+
+class RGBMeasurement(Measurement):
+    """A :class:`Measurement` of a :class:`RGBData` with an additional ``rgb`` field:
+        ``{"L": l, "R": r, "G": g, "B": b}`` computed from the ``raw_value``
+    """
+    __slots__ = ()
+    FIELDS = Measurement.FIELDS + ("rgb",)
+
+    @property
+    def rgb(self):
+        l,r,g,b = _vrgb(self.raw_value)
+        return dict(L=l, R=r, G=g, B=b)
+
 # #
 class Data(CallbackHandler):
     """Generic Data holder class with event generation
         
         :param quantity_name: (str) the name of the measured quantity (such as ``temperature``, ``voltage``)
         :param device: (:class:``AqaraDevice``) the instance of the :class:``AqaraDevice`` that contains this data
-        :param memory_depth: (int) size of the data buffer
+        :param memory_depth: (int) size of the data buffer (a :class:`RingBuffer`)
         :param event_list: ([str,...]) list of events generated by this Data
         :param units: (str) the units name of this Data values
 
         :returns: None
         :raises: :exc:`ValueError` (bad memory_depth)
 
+        measurements are instances of :attr:`measurement_class` (a :class:`Measurement`)
+
         **Events**:
             - ``data_new``: called on each :meth:`update` with the value provided
                 ``{"data_obj":self, "value": new_value, "event_type": "data_new", "measurement":new_measurement, "source_device": self.device}``
             - ``data_change`` : called whenever the new data is different for the previous one
                 ``{"data_obj":self, "value": new_value, "event_type": "data_change", "new_measurement":new_measurement, "old_measurement":old_measurement, "source_device": self.device}``
     """
+    measurement_class = Measurement
+
     def __init__(self, quantity_name, device, memory_depth = 10, event_list = ["data_new","data_change"], units=""):
         CallbackHandler.__init__(self,event_list=event_list)
         self.quantity_name = quantity_name
@@ -221,7 +644,9 @@ class Data(CallbackHandler):
         if self.depth < 0 :
             raise ValueError("memory depth should be a positive number, %r given"%memory_depth)
 
-        self.measurements = []
+        self.measurements = RingBuffer(self.depth)
+        self.columns = None
+        self.rollups = None
 
 
 
@@ -236,29 +661,35 @@ class Data(CallbackHandler):
             ``data_change`` event will be called.
         """
         timestamp = time.time()
-        measurement = {"source_device":self.device, "data_type": self.quantity_name, "data_units": self.units, "update_time": timestamp, "raw_value": value, "value": value}
-        #insert measurement
-        self.measurements.insert(0,measurement)
-        self.measurements = self.measurements[0:self.depth] # pop older values
+        measurement = self.measurement_class(self, timestamp, value)
+        previous = self.measurements[0] if len(self.measurements) else None
+        #insert measurement, overwrites the oldest one
+        self.measurements.append(measurement)
 
         #call the update hook
         self._update_hook(measurement)
+        if self.columns is not None:
+            self.columns.append(measurement.update_time, measurement.value)
+        if self.rollups is not None:
+            for tier in self.rollups.values():
+                tier.add(measurement.update_time, measurement.value)
 
         #Launch on_data_new
         self.on_data_new(measurement)
 
         #Launch onchange if values differ ...
-        if (len(self.measurements) >= 2) and ( measurement["raw_value"] != self.measurements[1]["raw_value"]):
-            self.on_data_change(measurement,self.measurements[1])
+        if previous is not None:
+            if measurement.raw_value != previous.raw_value:
+                self.on_data_change(measurement,previous)
         # ... or if it's the first measurement (it is a change)
-        elif len(self.measurements) == 1: 
+        elif len(self.measurements) == 1:
             self.on_data_change(measurement,None)
 
     def _update_hook(self,measurement):
         """Update hook
         
             this is called after Data has created a measurement and before events are launched
-            overide to change the measurement in children classes
+            overide to change the measurement in children classes (e.g. set ``measurement.value``)
         """
         pass
 
@@ -277,7 +708,7 @@ class Data(CallbackHandler):
 
             :param index: (int, optionnal, default 0) access to older measurements with 0 the last one 
             
-            a measurement is a ``dict`` with the following fields:
+            a measurement is a read-only mapping (a :class:`Measurement`) with the following fields:
                 - ``source_device``: the :class:`AqaraDevice` instance that contain this :class:`Data`
                 - ``data_type`` : the **quantity_name** (e.g. ``"temperature"``)
                 - ``update_time`` : the ``time.time()`` at which the event was recorded
@@ -295,18 +726,50 @@ class Data(CallbackHandler):
             :param index: (int, optionnal, default 0) access to older value with 0 the last one 
         """
         try:
-            measurement = self.measurements[index]
-            return measurement.get("value",measurement.get("raw_value"))
+            return self.measurements[index].value
         except:
             return None
 
+    def iter_measurements(self, count=None):
+        """Iterate over the ``count`` last measurements (all of them when ``None``), from the
+            newest to the oldest. See :meth:`get_measurement`
+        """
+        return self.measurements.iter_newest(count)
+
+    def _count_newer(self, timestamp, inclusive):
+        return _count_newer(self.measurements, "update_time", timestamp, inclusive)
+
+    def count_since(self, timestamp):
+        """the number of measurements recorded at or after ``timestamp`` (a ``time.time()``)"""
+        return self._count_newer(timestamp, True)
+
+    def get_at(self, timestamp):
+        """the measurement current at ``timestamp``: the last one recorded at or before it
+
+            :returns: a measurement (see :meth:`get_measurement`) or ``None`` if it is older than
+                the history
+        """
+        index = self._count_newer(timestamp, False)
+        return self.measurements[index] if index < len(self.measurements) else None
+
+    def get_range(self, t0, t1):
+        """the measurements recorded between ``t0`` (included) and ``t1`` (excluded)
+
+            :returns: a :class:`RingView` of the measurements, from the newest to the oldest.
+                It does not copy the history and is not changed by the next updates
+
+            the lookups are binary searches on ``update_time``, they assume that the
+            ``time.time()`` clock does not go backwards
+        """
+        return self.measurements.view(self._count_newer(t1, True), self._count_newer(t0, True))
+
 
     def on_data_new(self,new_measurement):
         """Called whenever a new measurement was received
 
             This calls back every subscriber to ``data_new`` event
         """
-        data = {"data_obj":self, "value": new_measurement["value"], "event_type": "data_new", "measurement":new_measurement, "source_device": self.device}
+        data = {"data_obj":self, "value": new_measurement.value, "event_type": "data_new", "measurement":new_measurement, "source_device": self.device}
         self._callback_on_event("data_new",data)
 
     def on_data_change(self, new_measurement, old_measurement):
@@ -318,15 +781,15 @@ class Data(CallbackHandler):
         """
 
         if old_measurement is None:
-            log.debug("%s first value is %r"%(self.quantity_name,new_measurement["raw_value"]))
+            log.debug("%s first value is %r", self.quantity_name, new_measurement["raw_value"])
         else:
-            log.debug("[%s] %s changed from %r to %r (%ds)\n"%(self.device.sid,self.quantity_name,new_measurement["raw_value"],old_measurement["raw_value"], int(new_measurement["update_time"] - old_measurement["update_time"])))
+            log.debug("[%s] %s changed from %r to %r (%ds)\n", self.device.sid, self.quantity_name, new_measurement["raw_value"], old_measurement["raw_value"], int(new_measurement["update_time"] - old_measurement["update_time"]))
 
 
         #call the _data_change_hook before calling back functions
         self._data_change_hook(new_measurement, old_measurement)
 
-        data = {"data_obj":self, "value": new_measurement["value"], "event_type": "data_change", "new_measurement":new_measurement, "old_measurement":old_measurement, "source_device": self.device}
+        data = {"data_obj":self, "value": new_measurement.value, "event_type": "data_change", "new_measurement":new_measurement, "old_measurement":old_measurement, "source_device": self.device}
         self._callback_on_event("data_change",data)
 
 # ##
@@ -337,7 +800,12 @@ class IPData(Data):
 
 # ##
 class RGBData(Data):
-    """RGB state (of the gateway) see :class:`Data` for methods and init"""
+    """RGB state (of the gateway) see :class:`Data` for methods and init
+
+        measurements have an additional ``rgb`` field, see :class:`RGBMeasurement`
+    """
+    measurement_class = RGBMeasurement
+
     def __init__(self, device, memory_depth = 10):
         Data.__init__(self,"rgb", device, memory_depth = memory_depth)
 
@@ -350,24 +818,7 @@ class RGBData(Data):
         """
         #returns a Value, R, G ,B byte record for measurement at index index (0: last)
         measurement = self.get_measurement(index=index)
-        val = int(measurement["raw_value"])
-        l = (val >> 24) & 0xff
-        r = (val >> 16) & 0xff
-        g = (val >> 8) & 0xff
-        b = val & 0xff
-        return(l,r,g,b)
-
-    def get_measurement(self,index=0):
-        """ get the measurement (see :meth:`Data.get_measurement` with additional
-            fields v, r, g and b
-        """
-
-        measurement = Data.get_measurement(self,index=index)
-        if measurement is None:
-            return None
-        l,r,g,b = self.get_vrgb(index=index)
-        measurement["rgb"] = dict(L=l, R=r, G=g, B=b)
-        return measurement
+        return _vrgb(measurement.raw_value)
 
 class StatusData(Data):
     """:class:`Data` with status type, see parentfor methods and init
@@ -382,9 +833,9 @@ class StatusData(Data):
         self.statuses=statuses
 
     def _update_hook(self,measurement):
-        if measurement["raw_value"] not in self.statuses:
-            self.statuses.append(measurement["raw_value"])
-            log.warning("unknown status '%s'"%(measurement["raw_value"]))
+        if measurement.raw_value not in self.statuses:
+            self.statuses.append(measurement.raw_value)
+            log.warning("unknown status '%s'"%(measurement.raw_value))
 
 # ##
 class SwitchStatusData(StatusData):
@@ -425,6 +876,9 @@ class CubeStatusData(StatusData):
         StatusData.__init__(self, device, memory_depth = memory_depth,
                 statuses=["alert","shake_air","flip90","flip180"])
 
+#default NumericData rollup tiers: (bucket period in seconds, number of buckets kept)
+DEFAULT_ROLLUPS = ((60, 24 * 60), (3600, 31 * 24), (86400, 366))
+
 # ##
 class NumericData(Data):
     """ A numeric data Holder
@@ -439,10 +893,38 @@ class NumericData(Data):
     def __init__(self,quantity_name, device, units= "", memory_depth = 10):
         Data.__init__(self,quantity_name, device, units=units, memory_depth = memory_depth, event_list = ["data_new","data_change","data_change_coarse"])
 
+    def enable_columns(self, depth):
+        """Also keep the ``depth`` last values in a :class:`NumericColumns` (requires numpy)
+
+            :param depth: (int) number of values kept, independent of ``memory_depth``
+            :returns: the :class:`NumericColumns`, also available as ``self.columns``
+            :raises: :exc:`ImportError` (numpy is not installed), :exc:`ValueError` (bad depth)
+
+            the columns start empty, and are replaced if they were already enabled.
+            Example: ``data.columns.mean(seconds=3600)`` averages the last hour
+        """
+        self.columns = NumericColumns(depth)
+        return self.columns
+
+    def enable_rollups(self, tiers = DEFAULT_ROLLUPS):
+        """Also aggregate the values in :class:`RollupTier`, for the charts over long periods
+
+            :param tiers: a list of ``(period, retention)``: the duration of the buckets in seconds
+                and the number of buckets kept by each tier. The default keeps a day of 1 minute
+                buckets, a month of 1 hour buckets and a year of 1 day buckets
+            :returns: an ``OrderedDict`` ``period -> RollupTier``, also available as ``self.rollups``
+            :raises: :exc:`ValueError` (bad period or retention)
+
+            the tiers start empty, and are replaced if they were already enabled.
+            Example: ``data.rollups[3600].get_range(t0, t1)`` returns the hourly buckets
+        """
+        self.rollups = collections.OrderedDict((period, RollupTier(period, retention)) for period, retention in tiers)
+        return self.rollups
+
     def _update_hook(self,measurement):
         """overide update hook to change values to float"""
-        measurement["value"] = float(measurement["raw_value"])
-        log.debug("NumericData update hook %r"%measurement)
+        measurement.value = float(measurement.raw_value)
+        log.debug("NumericData update hook %r", measurement)
 
     def _data_change_hook(self,new_measurement, old_measurement):
         """called on every data changes, callback whenever a change greater than precision occured"""
@@ -540,8 +1022,8 @@ class CubeRotateData(NumericData):
     def __init__(self,device,memory_depth = 10):
         NumericData.__init__(self,"rotate",device,units="deg",memory_depth = memory_depth)
     def _update_hook(self,measurement):
-        measurement["value"] = float(measurement["raw_value"].replace(",","."))
-        log.debug("NumericData update hook %r"%measurement)
+        measurement.value = float(measurement.raw_value.replace(",","."))
+        log.debug("NumericData update hook %r", measurement)
 
 
 # ###
@@ -562,9 +1044,9 @@ class VoltageData(NumericData):
     def __init__(self,device,memory_depth = 10):
         NumericData.__init__(self,"voltage",device,units="%",memory_depth = memory_depth)
     def _update_hook(self,measurement):
-        value = int(measurement["raw_value"])
+        value = int(measurement.raw_value)
         value = 100.0 * ((value - 2700.0) / (3100.0 - 2700.0))
-        measurement["value"] = value
+        measurement.value = value
 
 
 # ###
@@ -574,8 +1056,8 @@ class WeatherData(NumericData):
     def __init__(self,quantity_name, device, units="", memory_depth = 10):
         NumericData.__init__(self,quantity_name, device, units, memory_depth = memory_depth)
     def _update_hook(self,measurement):
-        measurement["value"] = float(measurement["raw_value"]) / 100.0
-        log.debug("Saving value %.2f for capability %s"%(measurement["value"],self.quantity_name))
+        measurement.value = float(measurement.raw_value) / 100.0
+        log.debug("Saving value %.2f for capability %s", measurement.value, self.quantity_name)
 
 
 # ####
@@ -807,6 +1289,164 @@ class AqaraController(AqaraSensor): #Every controller reports events, hence inhe
     def __init__(self,sid,model,capabilities=[]):
         AqaraSensor.__init__(self,sid,model,capabilities=capabilities)
 
+#####################
+def _settle(futures, result=None, exception=None):
+    """set the result (or the exception) of the ``futures``, skipping the ones cancelled by their caller"""
+    for future in futures:
+        if future.done():
+            continue
+        try:
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+        except Exception as e:
+            #cancelled by its caller since done() was checked
+            log.debug("Command future not settled: %r"%e)
+
+class CommandScheduler(object):
+    """Send the commands of a gateway at a bounded rate
+
+        :param send_function: a function ``send(command)`` that actually sends a ``write``
+            command (a ``dict``), called from the scheduler thread. It raises on failure
+        :param rate: (float) maximum number of commands sent per second
+        :param coalesce_window: (float) time in seconds a command waits before being sent.
+            A command of the same kind (same keys, e.g. two ``rgb`` commands) submitted
+            during that time replaces it: the last one wins
+        :param ack_timeout: (float) time in seconds to wait for the gateway ``write_ack``
+        :param max_pending: (int) maximum number of commands waiting to be sent, the oldest
+            one is dropped when it is exceeded
+
+        :meth:`submit` returns a :class:`concurrent.futures.Future` that is set to the
+        ``data`` of the ``write_ack`` packet, or fails with :exc:`TimeoutError` (no ack),
+        :exc:`ConnectionError` (the gateway answered with an error or the command could
+        not be sent) or :exc:`concurrent.futures.CancelledError` (dropped). The future of a
+        replaced command gets the result of the command that replaced it. Callers may cancel
+        their future: the command is still sent.
+
+        Acks carry no command identifier: they are matched to the sent commands in order.
+    """
+    def __init__(self, send_function, rate=5.0, coalesce_window=0.1, ack_timeout=2.0, max_pending=32):
+        self.send_function = send_function
+        self.interval = 1.0 / float(rate)
+        self.coalesce_window = float(coalesce_window)
+        self.ack_timeout = float(ack_timeout)
+        self.max_pending = int(max_pending)
+        self.pending = collections.OrderedDict() # kind -> [command, futures, submit_time]
+        self.in_flight = collections.deque()     # (futures, deadline)
+        self.condition = threading.Condition()
+        self.last_send = 0.
+        self.stats = collections.Counter(submitted=0, coalesced=0, dropped=0, sent=0, acked=0, errors=0, timeouts=0)
+        self._stopping = False
+        self.thread = threading.Thread(target=self._run, name="command_scheduler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, command):
+        """Queue a command
+
+            :param command: the ``dict`` of the ``write`` command ``data``
+            :returns: a :class:`concurrent.futures.Future`
+        """
+        future = concurrent.futures.Future()
+        kind = tuple(sorted(command.keys()))
+        with self.condition:
+            if self._stopping:
+                raise ConnectionAbortedError("command scheduler is stopped")
+            self.stats["submitted"] += 1
+            entry = self.pending.get(kind)
+            if entry is not None:
+                #supersede the waiting command, keep its place in the queue
+                entry[0] = command
+                entry[1].append(future)
+                self.stats["coalesced"] += 1
+            else:
+                self.pending[kind] = [command, [future], time.monotonic()]
+                if len(self.pending) > self.max_pending:
+                    kind, (command, futures, submit_time) = self.pending.popitem(last=False)
+                    self.stats["dropped"] += 1
+                    for dropped in futures:
+                        dropped.cancel()
+            self.condition.notify()
+        return future
+
+    def on_ack(self, packet):
+        """Match a ``write_ack`` packet with the oldest command waiting for an ack"""
+        data = packet.get("data")
+        failed = isinstance(data, dict) and data.get("error") is not None
+        with self.condition:
+            if not self.in_flight:
+                log.debug("unexpected write_ack %r"%data)
+                return
+            futures, deadline = self.in_flight.popleft()
+            self.stats["errors" if failed else "acked"] += 1
+        if failed:
+            _settle(futures, exception=ConnectionError("gateway error: %s"%data["error"]))
+        else:
+            _settle(futures, result=data)
+
+    def _expire(self, now):
+        expired = []
+        while self.in_flight and self.in_flight[0][1] <= now:
+            expired.append(self.in_flight.popleft()[0])
+        return expired
+
+    def _run(self):
+        while True:
+            to_send = None
+            with self.condition:
+                now = time.monotonic()
+                expired = self._expire(now)
+                self.stats["timeouts"] += len(expired)
+                if self._stopping and not self.pending:
+                    break
+                wake_up = None
+                if self.pending and not expired:
+                    kind, entry = next(iter(self.pending.items()))
+                    ready = max(entry[2] + self.coalesce_window, self.last_send + self.interval)
+                    if self._stopping or ready <= now:
+                        del(self.pending[kind])
+                        to_send = entry
+                        self.last_send = now
+                    else:
+                        wake_up = ready
+                if self.in_flight:
+                    deadline = self.in_flight[0][1]
+                    wake_up = deadline if wake_up is None else min(wake_up, deadline)
+                if to_send is None and not expired:
+                    self.condition.wait(None if wake_up is None else max(0, wake_up - now))
+                    continue
+            for futures in expired:
+                _settle(futures, exception=TimeoutError("no write_ack from gateway"))
+            if to_send is not None:
+                self._send(to_send[0], to_send[1])
+        with self.condition:
+            in_flight, self.in_flight = self.in_flight, collections.deque()
+        for futures, deadline in in_flight:
+            for future in futures:
+                future.cancel()
+
+    def _send(self, command, futures):
+        try:
+            self.send_function(command)
+        except Exception as e:
+            log.error("Unable to send command %r: %r"%(command, e))
+            with self.condition:
+                self.stats["errors"] += 1
+            _settle(futures, exception=ConnectionError("command not sent: %r"%e))
+            return
+        with self.condition:
+            self.stats["sent"] += 1
+            self.in_flight.append((futures, time.monotonic() + self.ack_timeout))
+            self.condition.notify()
+
+    def stop(self, timeout=None):
+        """Send the pending commands and stop the scheduler thread"""
+        with self.condition:
+            self._stopping = True
+            self.condition.notify()
+        self.thread.join(timeout)
+
 class AqaraGateway(AqaraController):
     """Gateway device
 
@@ -817,12 +1457,16 @@ class AqaraGateway(AqaraController):
         You can interact with the device using the methods below.
         Before any interaction, you MUST use the :meth:`set_password` (if not provided during init) and :meth:`set_command_handler` to set the gateway password and pass a callback method responsible for actually sending the packet data
 
+        Commands are sent immediately unless :meth:`enable_command_scheduler` was called.
     """
     def __init__(self,sid, model, capabilities=["ip","illumination","rgb"], aqara_password=None):
         AqaraController.__init__(self,sid,"gateway",capabilities=capabilities)
         self.last_token = None
         self.volume = 50
         self.password = None
+        self._cipher = None
+        self._write_key = None
+        self._write_key_token = None
         if aqara_password is not None:
             self.set_password(aqara_password)
 
@@ -830,6 +1474,7 @@ class AqaraGateway(AqaraController):
             raise ConnectionRefusedError("No callback was defined to send command")
         self.send_command_callback = raise_me
         self.last_ip = None
+        self.command_scheduler = None
 
     def set_password(self,aqara_password):
         """Sets the gateway password
@@ -843,6 +1488,8 @@ class AqaraGateway(AqaraController):
             raise ValueError("aqara_password should be a 16 chars string")
         
         self.password = aqara_password
+        self._cipher = None
+        self._write_key = None
 
     def set_command_handler(self,send_command_callback):
         """Sets the gateway password and command handler callback
@@ -858,6 +1505,30 @@ class AqaraGateway(AqaraController):
 
         self.send_command_callback = send_command_callback
 
+    def enable_command_scheduler(self, rate=5.0, coalesce_window=0.1, ack_timeout=2.0):
+        """Queue commands in a :class:`CommandScheduler` instead of sending them immediately
+
+            commands methods (:meth:`set_color`, :meth:`play_track`...) then return a
+            :class:`concurrent.futures.Future` set on the gateway ``write_ack``.
+            See :class:`CommandScheduler` for the arguments.
+        """
+        self.disable_command_scheduler()
+        self.command_scheduler = CommandScheduler(self._write, rate=rate,
+                coalesce_window=coalesce_window, ack_timeout=ack_timeout)
+        return self.command_scheduler
+
+    def disable_command_scheduler(self):
+        """Send the pending commands and go back to immediate sending"""
+        if self.command_scheduler is not None:
+            self.command_scheduler.stop()
+            self.command_scheduler = None
+
+    def command_stats(self):
+        """returns the :class:`CommandScheduler` counters (``None`` without scheduler)"""
+        if self.command_scheduler is None:
+            return None
+        return dict(self.command_scheduler.stats)
+
     def update(self,packet):
         """Update the current state of the Device with a new packet
 
@@ -873,8 +1544,14 @@ class AqaraGateway(AqaraController):
             
         """
         AqaraSensor.update(self,packet)
+        if self.last_cmd == "write_ack" and self.command_scheduler is not None:
+            self.command_scheduler.on_ack(packet)
         try:
-            self.last_token = packet["token"]
+            token = packet["token"]
+            if token != self.last_token:
+                #the cached write key is no longer valid
+                self._write_key = None
+            self.last_token = token
         except KeyError as e:
             pass
 
@@ -908,8 +1585,7 @@ class AqaraGateway(AqaraController):
 
         VRGB = "%02x%02x%02x%02x"%(v,r,g,b)
         command = {'rgb': int(VRGB,16)}
-        self._send_command(command)
-        pass
+        return self._send_command(command)
 
     def set_volume(self,volume):
         """sets the volume of the gateway
@@ -971,7 +1647,7 @@ class AqaraGateway(AqaraController):
         if volume is None:
             volume=self.volume
         command={'mid':int(track_number), 'vol': volume}
-        self._send_command(command)
+        return self._send_command(command)
 
     def stop_track(self):
         """stops the currently-playing track initiated by :meth:`play_track`
@@ -985,7 +1661,7 @@ class AqaraGateway(AqaraController):
         """
         volume=self.volume
         command={'mid': 10000, 'vol': volume}
-        self._send_command(command)
+        return self._send_command(command)
 
     def _send_command(self,command):
         """send a command to the gateway
@@ -996,6 +1672,8 @@ class AqaraGateway(AqaraController):
 
             :param command: a ``dict`` containing the data for the 
                 Xiaomi Aqara ``write`` cmd
+            :returns: ``None`` or a :class:`concurrent.futures.Future` when the
+                command scheduler is enabled
 
             :raises:
                 - :exc:`ConnectionAbortedError`: the gateway ``token`` was not
@@ -1016,35 +1694,68 @@ class AqaraGateway(AqaraController):
             log.error("Unable to send command: password is not set")
             raise  ConnectionRefusedError("password was not set yet for Gateway, Aborting")
 
-        from Crypto.Cipher import AES
-        IV_AQUARA = bytes.fromhex("17996d093d28ddb3ba695a2e6f58562e")
-        aes = AES.new(self.password, AES.MODE_CBC, (IV_AQUARA))
-        #encrypt last token to determine write_key
-        ciphertext = aes.encrypt(self.last_token)
-        import binascii
-        write_key = binascii.hexlify(ciphertext).decode("utf-8")
-        command['key'] = write_key
+        if self.command_scheduler is not None:
+            return self.command_scheduler.submit(command)
+
+        try:
+            self._write(command)
+        except:
+            log.error("Unable to send command to aqara %s"%self.last_ip)
+            log.exception("Exception:")
+
+    IV_AQUARA = bytes.fromhex("17996d093d28ddb3ba695a2e6f58562e")
+
+    def _get_write_key(self):
+        """returns the write key: the last token AES-CBC encrypted with the password
+
+            The block cipher is created once per password and the key is computed
+            once per token (tokens change with the gateway heartbeats).
+            CBC is chained by hand over the (stateless) ECB cipher, so the cipher can be reused.
+        """
+        token = self.last_token
+        if self._write_key is not None and self._write_key_token == token:
+            return self._write_key
+        if self._cipher is None:
+            if AES is None:
+                raise ImportError("pycryptodome is needed to send commands to the gateway")
+            self._cipher = AES.new(self.password.encode("utf-8"), AES.MODE_ECB)
+        plaintext = token.encode("utf-8") if isinstance(token, str) else token
+        previous = self.IV_AQUARA
+        ciphertext = b""
+        for i in range(0, len(plaintext), 16):
+            block = bytes(a ^ b for a, b in zip(plaintext[i:i+16], previous))
+            previous = self._cipher.encrypt(block)
+            ciphertext += previous
+        self._write_key = binascii.hexlify(ciphertext).decode("utf-8")
+        self._write_key_token = token
+        return self._write_key
+
+    def _write(self,command):
+        """encrypt the token, build the ``write`` packet and give it to the command handler"""
+        command['key'] = self._get_write_key()
         write_command = {
             "cmd": u"write",
             "model": self.model,
             "sid":self.sid,
             "short_id":self.short_id,
             "data":command }
-        import json
-        write_command = json.dumps(write_command)
+        write_command = codec.dumps(write_command)
         log.debug("Sending commmand to gateway %s %r"%(self.sid,write_command))
-
-        try:
-            self.send_command_callback(write_command,self.last_ip,9898)
-        except:
-            log.error("Unable to send command to aqara %s:%d")
-            log.exception("Exception:")
+        self.send_command_callback(write_command,self.last_ip,9898)
 
 #################################################################################################################
 class AqaraRoot(CallbackHandler):
     """Hub for Aqara devices
 
         :param known_devices_file: (str) name of the file that hold device context. see :class:`KnownDevices`
+        :param known_devices_read_only: (bool) never write ``known_devices_file``, see :class:`KnownDevices`
+        :param latency_sample: (int) the latencies are measured for one packet in ``latency_sample``,
+            ``0`` disables them (see :class:`aqara_metrics.Metrics`)
+        :param dedupe_ttl: (float, opt) when set, repeated packets are dropped before reaching
+            the devices, see :class:`PacketDeduplicator`
+        :param dedupe_size: (int) number of ``(sid, cmd)`` remembered by the deduplicator
+
+        Ingest metrics are returned by :meth:`stats`.
 
         **Events**
         This class supports the registering of events of type ``device_new``. Subscribers will be called back with
@@ -1053,13 +1764,25 @@ class AqaraRoot(CallbackHandler):
 
         To create devices and capabilities, repeatdly call :meth:`AqaraRoot.handle_packet` with aqara gateway packets
     """
-    def __init__(self, known_devices_file = "known_devices.json"):
+    def __init__(self, known_devices_file = "known_devices.json", dedupe_ttl = None, dedupe_size = 1024, known_devices_read_only = False, latency_sample = 16):
         CallbackHandler.__init__(self,event_list=["device_new"])
-        self.KD = KnownDevices(known_devices_file = known_devices_file)
+        self.deduplicator = None
+        if dedupe_ttl is not None:
+            self.deduplicator = PacketDeduplicator(ttl=dedupe_ttl, max_entries=dedupe_size)
+        self.KD = KnownDevices(known_devices_file = known_devices_file, read_only = known_devices_read_only)
         self.dev_by_sid = {}
         self.dev_by_room = {}
         self.dev_by_model = {}
         self.dev_by_capability = {}
+        self.metrics = Metrics(latency_sample = latency_sample)
+        self._decode_latency = self.metrics.histogram("decode")
+        self._context_latency = self.metrics.histogram("context")
+        self._update_latency = self.metrics.histogram("device_update")
+        self._handle_latency = self.metrics.histogram("handle_packet")
+        self.metrics.gauge("devices", lambda: len(self.dev_by_sid))
+        self.metrics.gauge("devices_by_model", lambda: dict((model, len(devices)) for model, devices in self.dev_by_model.items()))
+        if self.deduplicator is not None:
+            self.metrics.gauge("dedupe", self.deduplicator.stats)
 
     def __update_device(self,packet):
         """ packet: a dict containing a parsed aqara packet enriched with a context """
@@ -1135,20 +1858,59 @@ class AqaraRoot(CallbackHandler):
         """Handle a new packet from the Aqara gateway
 
             :param data: the packet content. This can be either a json string or a decoded dict
+                (see :func:`aqara_codec.decode_packet`)
 
             :raises: :exc:`ValueError`: ``data`` parameter is invalid
         
         """
+        counters = self.metrics.counters
+        timed = self.metrics.sample()
+        if timed:
+            start = time.perf_counter_ns()
+        #received is not counted here: stats() adds up the other counters
         try:
-            if isinstance(data,str):
-                data = json.loads(data)
+            if isinstance(data,(str,bytes)):
+                data = codec.decode_packet(data)
             if (data.get("data") is not None) and (isinstance(data["data"],str)):
-                parsed_data = json.loads(data["data"])
+                parsed_data = codec.loads(data["data"])
                 data["data"] = parsed_data
+            if (self.deduplicator is not None) and self.deduplicator.is_duplicate(data):
+                log.debug("handle_packet: dropping duplicate packet from %s", data.get("sid"))
+                counters["duplicates"] += 1
+                return
         except Exception as e:
+            counters["decode_errors"] += 1
             log.error("handle_packet: Error handling packet (%r): %r"%(data,e))
             raise ValueError("Invalid data parameter for AqaraRoot.handle_packet")
+        if timed:
+            decoded = time.perf_counter_ns()
+            self._decode_latency.observe(decoded - start)
+        counters[(PACKETS_BY_CMD_AND_MODEL, (data.get("cmd"), data.get("model")))] += 1
 
         data["context"] = self.KD.get_context(data)
+        if timed:
+            context_done = time.perf_counter_ns()
+            self._context_latency.observe(context_done - decoded)
 
         device = self.__update_device(data)
+        if timed:
+            end = time.perf_counter_ns()
+            self._update_latency.observe(end - context_done)
+            self._handle_latency.observe(end - start)
+
+    def stats(self):
+        """Returns the packet handling metrics
+
+            a dict (see :meth:`aqara_metrics.Metrics.snapshot`) with:
+                - ``counters``: ``received``, ``duplicates``, ``decode_errors``,
+                  ``packets_by_cmd`` and ``packets_by_model``
+                - ``latencies`` (in ns): ``decode``, ``context`` (:meth:`KnownDevices.get_context`),
+                  ``device_update`` (device and :class:`Data` updates with their callbacks)
+                  and ``handle_packet`` (the whole call)
+                - ``gauges``: ``devices`` count and ``devices_by_model``, the deduplicator state
+        """
+        stats = self.metrics.snapshot()
+        counters = stats["counters"]
+        counters["received"] = (sum(counters.get("packets_by_cmd", {}).values())
+                                + counters.get("duplicates", 0) + counters.get("decode_errors", 0))
+        return stats
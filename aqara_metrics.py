@@ -0,0 +1,120 @@
+""" Low overhead ingest metrics
+
+    Counters are plain ``collections.defaultdict(int)`` entries (``collections.Counter``
+    increments are about three times slower) and latencies go to
+    histograms with power of two buckets, so recording a metric costs a couple
+    of dict operations. Updates are not locked: counters updated from several
+    threads may miss a few increments.
+
+    Timing a packet costs more than counting it, so latencies are only measured for
+    one packet in :attr:`Metrics.latency_sample` (see :meth:`Metrics.sample`).
+"""
+import collections
+import itertools
+import time
+
+#counter name of the packets broken down by cmd and by model, see :class:`Metrics`
+PACKETS_BY_CMD_AND_MODEL = ("packets_by_cmd", "packets_by_model")
+
+class Histogram(object):
+    """Latency histogram in nanoseconds with power of two buckets"""
+    __slots__ = ("buckets", "count", "total", "max")
+
+    def __init__(self):
+        self.buckets = [0] * 64
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def observe(self, value):
+        """record a value (an ``int`` number of nanoseconds)"""
+        self.buckets[value.bit_length()] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """upper bound (in ns) of the bucket that holds the ``percent`` percentile"""
+        if self.count == 0:
+            return 0
+        rank = self.count * percent / 100.0
+        seen = 0
+        for bit_length, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return min((1 << bit_length) - 1, self.max)
+        return self.max
+
+    def summary(self):
+        """returns a dict with ``count``, ``mean_ns``, ``p50_ns``, ``p99_ns`` and ``max_ns``"""
+        return {"count": self.count,
+                "mean_ns": self.total / self.count if self.count else 0,
+                "p50_ns": self.percentile(50),
+                "p99_ns": self.percentile(99),
+                "max_ns": self.max}
+
+class Metrics(object):
+    """A registry of counters, gauges and latency histograms
+
+        :param latency_sample: (int) the histograms observe one event in ``latency_sample``,
+            ``0`` disables them
+
+        - counters are incremented with ``metrics.counters[name] += 1``. A name can be
+          a ``(name, label)`` tuple to break a counter down (e.g. ``("packets_by_cmd", "report")``).
+          A ``((name, ...), (label, ...))`` tuple breaks down several counters with a single
+          increment (e.g. ``(("packets_by_cmd", "packets_by_model"), ("report", "weather.v2"))``)
+        - gauges are functions evaluated by :meth:`snapshot`, see :meth:`gauge`
+        - histograms are created by :meth:`histogram` and fed with :meth:`Histogram.observe`,
+          when :meth:`sample` returns ``True``
+    """
+    def __init__(self, latency_sample=16):
+        self.counters = collections.defaultdict(int)
+        self.gauges = {}
+        self.histograms = {}
+        self.start_time = time.time()
+        self.latency_sample = int(latency_sample)
+        if self.latency_sample > 0:
+            ticks = itertools.cycle([True] + [False] * (self.latency_sample - 1))
+        else:
+            ticks = itertools.repeat(False)
+        #sample(): True once every latency_sample calls, a builtin for a low overhead
+        self.sample = ticks.__next__
+
+    def histogram(self, name):
+        """returns the :class:`Histogram` ``name``, created if needed"""
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        return histogram
+
+    def gauge(self, name, function):
+        """register a gauge: ``function()`` is called by :meth:`snapshot` to read its value"""
+        self.gauges[name] = function
+
+    def snapshot(self):
+        """returns a dict of every metric
+
+            ``{"uptime": s, "counters": {...}, "gauges": {...}, "latencies": {name: summary}}``.
+            Counters named ``(name, label)`` are grouped as ``{name: {label: value}}``.
+        """
+        counters = {}
+        for key, value in list(self.counters.items()):
+            if isinstance(key, tuple) and isinstance(key[0], tuple):
+                for name, label in zip(*key):
+                    labels = counters.setdefault(name, {})
+                    labels[label] = labels.get(label, 0) + value
+            elif isinstance(key, tuple):
+                counters.setdefault(key[0], {})[key[1]] = value
+            else:
+                counters[key] = value
+        gauges = {}
+        for name, function in self.gauges.items():
+            try:
+                gauges[name] = function()
+            except Exception as e:
+                gauges[name] = None
+        return {"uptime": time.time() - self.start_time,
+                "counters": counters,
+                "gauges": gauges,
+                "latencies": dict((name, histogram.summary()) for name, histogram in self.histograms.items())}
@@ -0,0 +1,123 @@
+""" Spread packet handling over several processes
+
+    The multicast socket is read by a single process: the kernel delivers a copy
+    of every multicast datagram to each socket bound with ``SO_REUSEPORT``, so
+    binding the port in every worker would not split the load. Instead, the
+    receiving process shards decoded packets on their ``sid`` and each worker
+    process owns a :class:`aqara_devices.AqaraRoot` for its share of the devices.
+    A device is always handled by the same worker and its packets are handled
+    in arrival order.
+"""
+import multiprocessing
+import zlib
+import importlib
+import aqara_devices as AD
+import logging
+log = logging.getLogger(__name__)
+
+def shard_for(sid, shards):
+    """Returns the shard (in ``range(shards)``) that handles ``sid``
+
+        the result is stable across processes and runs (unlike :func:`hash`)
+    """
+    if isinstance(sid, str):
+        sid = sid.encode("utf-8")
+    return zlib.crc32(sid) % shards
+
+def load_function(path):
+    """Load a function from a ``"module:function"`` string"""
+    module_name, _, function_name = path.partition(":")
+    if not function_name:
+        raise ValueError("%r is not of the form module:function"%path)
+    return getattr(importlib.import_module(module_name), function_name)
+
+def _worker_main(index, queue, known_devices_file, worker_init):
+    #the dispatcher process owns (and writes) the known devices file
+    root = AD.AqaraRoot(known_devices_file = known_devices_file, known_devices_read_only = True)
+    if worker_init is not None:
+        if isinstance(worker_init, str):
+            worker_init = load_function(worker_init)
+        worker_init(root, index)
+    log.info("worker %d started"%index)
+    while True:
+        payload = queue.get()
+        if payload is None:
+            break
+        try:
+            root.handle_packet(payload)
+        except Exception:
+            log.exception("worker %d: error handling packet %r"%(index, payload))
+    log.info("worker %d exiting"%index)
+
+class ShardedDispatcher:
+    """Dispatch packets to worker processes, sharded by ``sid``
+
+        :param workers: (int) number of worker processes (defaults to the number of cores)
+        :param worker_init: (opt) a function ``init(root, worker_index)`` (or a ``"module:function"``
+            string) called in each worker with its :class:`aqara_devices.AqaraRoot`, typically
+            to register ``device_new`` callbacks
+        :param known_devices_file: (str) see :class:`aqara_devices.KnownDevices`. The file is
+            only written by the dispatching process, when :meth:`dispatch` sees a new sid:
+            workers open it read-only
+        :param queue_size: (int) maximum number of packets waiting for each worker.
+            :meth:`data_callback` blocks when the queue of the target worker is full
+
+        Usage::
+
+            with ShardedDispatcher(workers=4, worker_init=setup) as dispatcher:
+                connector = aqara.AquaraConnector(data_callback=dispatcher.data_callback)
+    """
+    def __init__(self, workers=None, worker_init=None, known_devices_file="known_devices.json", queue_size=10000):
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self.workers = int(workers)
+        if self.workers < 1:
+            raise ValueError("workers should be a positive number, %r given"%workers)
+        self.queues = [multiprocessing.Queue(queue_size) for i in range(self.workers)]
+        self.processes = [multiprocessing.Process(target=_worker_main,
+                                                  name="aqara_worker_%d"%i,
+                                                  args=(i, self.queues[i], known_devices_file, worker_init))
+                          for i in range(self.workers)]
+        self.dispatched = [0] * self.workers
+        self.known_devices = AD.KnownDevices(known_devices_file = known_devices_file)
+        self.started = False
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+        self.started = True
+        return self
+
+    def __enter__(self):
+        if not self.started:
+            self.start()
+        return self
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.stop()
+
+    def dispatch(self, payload):
+        """Send a decoded packet to the worker that owns its ``sid``"""
+        sid = payload.get("sid","")
+        if (sid not in self.known_devices.known_devices) and ("model" in payload):
+            #single writer of the file, the worker gets the same context from its read-only copy
+            self.known_devices.get_context(payload)
+        index = shard_for(sid, self.workers)
+        self.queues[index].put(payload)
+        self.dispatched[index] += 1
+
+    def data_callback(self, address, kind, payload):
+        """A :class:`aqara.AquaraConnector` ``data_callback``"""
+        self.dispatch(payload)
+
+    def stop(self, timeout=5):
+        """Let the workers handle their pending packets and wait for them"""
+        if not self.started:
+            return
+        self.started = False
+        for queue in self.queues:
+            queue.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                log.warning("%s did not exit, terminating"%process.name)
+                process.terminate()
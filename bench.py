@@ -0,0 +1,353 @@
+""" Benchmarks
+
+    python bench.py fanout [--clients 10 100 1000] [--messages 200] [--rate 500]
+        fan-out latency of :class:`diffusion_server.AsyncDiffusionServer`: the server and
+        its clients share one event loop (one core). Latency is measured from
+        ``send_message`` to the decoding of the message by each client.
+
+    python bench.py encoding [--packets 20000]
+        bytes per packet and encode/decode cost of each wire encoding of
+        :mod:`diffusion_codec`, for one connection receiving a stream of packets.
+
+    python bench.py transports [--messages 5000] [--rate 2000]
+        latency and CPU cost of the same host transports of :class:`diffusion_server.DiffusionServer`:
+        TCP loopback, unix domain socket and shared memory ring. The consumer runs in
+        another process, latency is measured from ``send_message`` to the callback.
+
+    python bench.py load [--clients 50] [--slow-clients 2] [--rate 1000] [--duration 10]
+        load test of :class:`diffusion_server.DiffusionServer` (also ``python diffusion_server.py``):
+        synthetic :class:`diffusion_server.DiffusionClient` s in ``--processes`` processes
+        receive ``--rate`` realistic packets per second. Slow clients sleep ``--slow-delay``
+        seconds per message. Reports the latency percentiles of normal and slow clients,
+        the delivered throughput and the CPU time per message of the server and the clients.
+
+    python bench.py history [--depths 10 1000 100000] [--updates 100000]
+        cost of :meth:`aqara_devices.Data.update` on a full history of each depth, the
+        memory held per measurement and, with numpy, the cost of a mean over the history.
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import threading
+import tracemalloc
+import multiprocessing
+import diffusion_server as DS
+import diffusion_codec
+import diffusion_shm
+import aqara_devices as AD
+from reactor import Reactor
+import aqara_codec as codec
+
+def percentile(values, percent):
+    """``percent`` percentile of ``values`` (nearest rank)"""
+    if not values:
+        return 0.
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(percent / 100.0 * len(values))) - 1))
+    return values[index]
+
+def sample_packet(i):
+    """a realistic aqara report, ``i`` selects the device"""
+    packet = dict(codec._SAMPLE_PACKETS[i % len(codec._SAMPLE_PACKETS)])
+    packet["sid"] = "%s%02d"%(packet["sid"][:-2], i % 40)
+    return packet
+
+def print_latencies(title, latencies, count, elapsed):
+    print("%-24s p50 %7.3f ms  p99 %7.3f ms  max %7.3f ms  %9.0f msg/s"%(title,
+          percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+          max(latencies or [0]) * 1000, count / elapsed))
+
+#################################################################################################################
+async def _fanout(clients, messages, rate):
+    server = DS.AsyncDiffusionServer(("127.0.0.1", 0))
+    await server.start()
+    latencies = []
+
+    async def client():
+        reader, writer = await asyncio.open_connection("127.0.0.1", server.port())
+        #subscribe to everything, as a DiffusionClient does
+        writer.write(DS.frame(codec.dumpb(DS.Subscription().to_message())))
+        frames = DS.FrameReader()
+        received = 0
+        try:
+            while received < messages:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                for message in frames.feed(data):
+                    latencies.append(time.perf_counter() - codec.loads(message)["_sent_"])
+                    received += 1
+        finally:
+            writer.close()
+
+    tasks = [asyncio.ensure_future(client()) for i in range(clients)]
+    while sum(not client.handshaking for client in server.active_connections.values()) < clients:
+        await asyncio.sleep(0.01)
+
+    start = time.perf_counter()
+    for i in range(messages):
+        packet = sample_packet(i)
+        packet["_sent_"] = time.perf_counter()
+        server.send_message(codec.dumpb(packet))
+        await asyncio.sleep(1.0 / rate)
+    await asyncio.wait_for(asyncio.gather(*tasks), timeout=60)
+    elapsed = time.perf_counter() - start
+    server.stop()
+    await server.wait_closed()
+    return latencies, elapsed
+
+def fanout(clients=(10, 100, 1000), messages=200, rate=500):
+    for count in clients:
+        latencies, elapsed = asyncio.run(_fanout(count, messages, rate))
+        print_latencies("fanout %d clients"%count, latencies, len(latencies), elapsed)
+
+#################################################################################################################
+def encoding(packets=20000):
+    messages = [codec.dumpb(sample_packet(i)) for i in range(packets)]
+    raw_size = sum(len(message) for message in messages)
+    for name in diffusion_codec.ENCODINGS:
+        for compression in diffusion_codec.COMPRESSIONS:
+            encoder = diffusion_codec.StreamEncoder(name, compression)
+            decoder = diffusion_codec.StreamDecoder(name, compression)
+            start = time.perf_counter()
+            payloads = [encoder.encode(message) for message in messages]
+            encode_time = time.perf_counter() - start
+            start = time.perf_counter()
+            for payload in payloads:
+                decoder.decode(payload)
+            decode_time = time.perf_counter() - start
+            size = sum(len(payload) + DS.FRAME_HEADER.size for payload in payloads)
+            print("%-8s %-5s %7.1f bytes/packet (%5.1f%%)  encode %6.2f us  decode %6.2f us"%(name, compression,
+                  size / float(packets), 100.0 * size / (raw_size + DS.FRAME_HEADER.size * packets),
+                  encode_time / packets * 1e6, decode_time / packets * 1e6))
+
+#################################################################################################################
+def _transport_consumer(transport, port, unix_path, shm_name, messages, results):
+    latencies = []
+    done = threading.Event()
+
+    def callback(message, kind):
+        packet = codec.loads(message)
+        if "_sent_" in packet:
+            latencies.append(time.perf_counter() - packet["_sent_"])
+            if len(latencies) >= messages:
+                done.set()
+
+    start_cpu = time.process_time()
+    if transport == "shm":
+        client = diffusion_shm.SharedRingClient(callback, shm_name)
+    else:
+        client = DS.DiffusionClient(callback, "127.0.0.1", port, unix_path = unix_path if transport == "unix" else None)
+    results.put("ready")
+    done.wait(60)
+    cpu = time.process_time() - start_cpu
+    client.stop()
+    results.put((latencies, cpu))
+
+def transports(messages=5000, rate=2000, port=10999):
+    unix_path = "/tmp/aqara_bench_%d.sock"%os.getpid()
+    shm_name = "aqara_bench_%d"%os.getpid()
+    for transport in ("tcp", "unix", "shm"):
+        server = DS.DiffusionServer(("127.0.0.1", port), snapshot = False,
+                                    unix_path = unix_path, shm_name = shm_name)
+        #an independent consumer process, as record.py or the GUI would be
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        consumer = context.Process(target=_transport_consumer,
+                                           args=(transport, port, unix_path, shm_name, messages, results))
+        consumer.start()
+        results.get(timeout=10)
+        while transport != "shm" and not server.has_clients():
+            time.sleep(0.01)
+        time.sleep(0.1)
+        start_cpu = time.process_time()
+        start = time.perf_counter()
+        for i in range(messages):
+            packet = sample_packet(i)
+            packet["_sent_"] = time.perf_counter()
+            server.send_message(codec.dumpb(packet))
+            time.sleep(1.0 / rate)
+        latencies, consumer_cpu = results.get(timeout=60)
+        elapsed = time.perf_counter() - start
+        server_cpu = time.process_time() - start_cpu
+        consumer.join()
+        server.stop()
+        time.sleep(0.2)
+        print_latencies("transport %s"%transport, latencies, len(latencies), elapsed)
+        print("%-24s server %.1f us/msg  consumer %.1f us/msg (CPU)"%("", server_cpu / messages * 1e6,
+              consumer_cpu / max(1, len(latencies)) * 1e6))
+        port += 1
+
+#################################################################################################################
+def _load_clients(port, clients, slow_clients, slow_delay, ready, stop, results):
+    latencies = []
+    slow_latencies = []
+
+    def make_callback(latencies, delay):
+        def callback(message, kind):
+            sent = codec.loads(message).get("_sent_")
+            if sent is not None:
+                latencies.append(time.perf_counter() - sent)
+                if delay:
+                    time.sleep(delay)
+        return callback
+
+    #normal clients share a reactor, each slow client has its own so that it only delays itself
+    reactor = Reactor()
+    connections = [DS.DiffusionClient(make_callback(latencies, 0), "127.0.0.1", port, reactor = reactor)
+                   for i in range(clients)]
+    connections += [DS.DiffusionClient(make_callback(slow_latencies, slow_delay), "127.0.0.1", port)
+                    for i in range(slow_clients)]
+    reactor_thread = threading.Thread(target=reactor.run_forever, name="load_reactor")
+    reactor_thread.start()
+    start_cpu = time.process_time()
+    ready.put(True)
+    stop.wait()
+    cpu = time.process_time() - start_cpu
+    for connection in connections:
+        connection.stop()
+    reactor.stop()
+    reactor_thread.join()
+    results.put((latencies, slow_latencies, cpu))
+
+def load(clients=50, slow_clients=2, rate=1000, duration=10., slow_delay=0.005, processes=None, port=10998):
+    processes = processes or max(1, min(4, multiprocessing.cpu_count() - 1))
+    server = DS.DiffusionServer(("127.0.0.1", port), snapshot = False)
+    context = multiprocessing.get_context("spawn")
+    ready = context.Queue()
+    results = context.Queue()
+    stop = context.Event()
+    workers = []
+    for i in range(processes):
+        #spread the normal and the slow clients over the processes
+        count = clients // processes + (1 if i < clients % processes else 0)
+        slow_count = slow_clients // processes + (1 if i < slow_clients % processes else 0)
+        worker = context.Process(target=_load_clients,
+                                 args=(port, count, slow_count, slow_delay, ready, stop, results))
+        worker.start()
+        workers.append(worker)
+    for worker in workers:
+        ready.get(timeout=60)
+    deadline = time.time() + 10
+    while len(server.active_connections) < clients + slow_clients and time.time() < deadline:
+        time.sleep(0.01)
+    print("%d clients connected (%d slow) in %d processes, %.0f msg/s for %.0fs"%(
+          len(server.active_connections), slow_clients, processes, rate, duration))
+
+    messages = int(rate * duration)
+    start_cpu = time.process_time()
+    start = time.perf_counter()
+    next_time = start
+    for i in range(messages):
+        packet = sample_packet(i)
+        packet["_sent_"] = time.perf_counter()
+        server.send_message(codec.dumpb(packet))
+        next_time += 1.0 / rate
+        delay = next_time - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+    publish_time = time.perf_counter() - start
+    #let the clients catch up
+    time.sleep(1.)
+    elapsed = time.perf_counter() - start
+    server_cpu = time.process_time() - start_cpu
+    client_stats = server.client_stats()
+    stop.set()
+    latencies, slow_latencies, clients_cpu = [], [], 0.
+    for worker in workers:
+        worker_latencies, worker_slow_latencies, worker_cpu = results.get(timeout=60)
+        latencies += worker_latencies
+        slow_latencies += worker_slow_latencies
+        clients_cpu += worker_cpu
+    for worker in workers:
+        worker.join()
+    disconnected = server.disconnected_slow_clients
+    server.stop()
+
+    delivered = len(latencies) + len(slow_latencies)
+    print("published %d messages at %.0f msg/s"%(messages, messages / publish_time))
+    print_latencies("normal clients", latencies, len(latencies), elapsed)
+    if slow_clients:
+        print_latencies("slow clients", slow_latencies, len(slow_latencies), elapsed)
+    print("delivered %d messages (%.0f msg/s), %d slow client disconnections, max lag %.3f s"%(
+          delivered, delivered / elapsed, disconnected, max([stats["max_lag"] for stats in client_stats] or [0])))
+    print("CPU: server %.1f us/published msg, clients %.1f us/delivered msg"%(
+          server_cpu / messages * 1e6, clients_cpu / max(1, delivered) * 1e6))
+
+#################################################################################################################
+def history(depths=(10, 1000, 100000), updates=100000):
+    device = AD.AqaraDevice("158d0001a2b3c4", "weather.v2")
+    for depth in depths:
+        #fill the history first: only the steady state matters
+        tracemalloc.start()
+        data = AD.TemperatureData(device, memory_depth=depth)
+        for i in range(depth):
+            data.update(str(2000 + i % 100))
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        start = time.perf_counter()
+        for i in range(updates):
+            data.update(str(2000 + i % 100))
+        elapsed = time.perf_counter() - start
+        print("memory_depth %-8d %6.2f us/update %8.1f bytes/measurement"%(depth, elapsed / updates * 1e6, memory / max(depth, 1)))
+
+        if AD.numpy is None or depth == 0:
+            continue
+        #average of the whole history: python loop against the columnar history
+        start = time.perf_counter()
+        sum(data.get_value(i) for i in range(depth)) / depth
+        loop = time.perf_counter() - start
+        data.enable_columns(depth)
+        for i in range(depth):
+            data.update(str(2000 + i % 100))
+        start = time.perf_counter()
+        data.columns.mean()
+        columns = time.perf_counter() - start
+        print("    mean of %d values: get_value loop %.3f ms, columns %.3f ms"%(depth, loop * 1e3, columns * 1e3))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="aqara benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark")
+    fanout_parser = subparsers.add_parser("fanout", help="AsyncDiffusionServer fan-out latency")
+    fanout_parser.add_argument("--clients", type=int, nargs="+", default=[10, 100, 1000])
+    fanout_parser.add_argument("--messages", type=int, default=200)
+    fanout_parser.add_argument("--rate", type=float, default=500, help="messages per second")
+
+    encoding_parser = subparsers.add_parser("encoding", help="wire encodings size and cost")
+    encoding_parser.add_argument("--packets", type=int, default=20000)
+
+    transports_parser = subparsers.add_parser("transports", help="tcp, unix socket and shared memory latency")
+    transports_parser.add_argument("--messages", type=int, default=5000)
+    transports_parser.add_argument("--rate", type=float, default=2000, help="messages per second")
+
+    load_parser = subparsers.add_parser("load", help="DiffusionServer load test")
+    load_parser.add_argument("--clients", type=int, default=50)
+    load_parser.add_argument("--slow-clients", type=int, default=2)
+    load_parser.add_argument("--slow-delay", type=float, default=0.005, help="seconds per message of slow clients")
+    load_parser.add_argument("--rate", type=float, default=1000, help="messages per second")
+    load_parser.add_argument("--duration", type=float, default=10, help="seconds")
+    load_parser.add_argument("--processes", type=int, default=None, help="client processes")
+
+    history_parser = subparsers.add_parser("history", help="Data.update cost by history depth")
+    history_parser.add_argument("--depths", type=int, nargs="+", default=[10, 1000, 100000])
+    history_parser.add_argument("--updates", type=int, default=100000)
+
+    args = parser.parse_args(argv)
+    if args.benchmark == "fanout":
+        fanout(args.clients, args.messages, args.rate)
+    elif args.benchmark == "encoding":
+        encoding(args.packets)
+    elif args.benchmark == "transports":
+        transports(args.messages, args.rate)
+    elif args.benchmark == "history":
+        history(args.depths, args.updates)
+    elif args.benchmark == "load":
+        load(args.clients, args.slow_clients, args.rate, args.duration, args.slow_delay, args.processes)
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,6 @@
+""" pytest configuration
+
+    Its presence at the root of the repository puts the root on ``sys.path``, so the
+    tests import the top level modules (``diffusion_server``, ``reactor``...) with a
+    plain ``pytest`` run as well as with ``python -m pytest``
+"""
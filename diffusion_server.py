@@ -1,70 +1,493 @@
 import socket
 import sys
+import os
+import stat
+import re
+import struct
+import time
+import itertools
+import collections
 import threading
+import asyncio
 try:
     import Queue
 except ImportError:
     import queue as Queue
 
+from reactor import Reactor, EVENT_READ, EVENT_WRITE
+import aqara_codec as codec
+import diffusion_codec
+import diffusion_shm
+from aqara_metrics import Metrics
+
 import logging
 log = logging.getLogger(__name__)
 
 DEFAULT_PORT = 10001
+
+#Every message is sent as a frame: its length as a 4 bytes big endian integer, then the message
+FRAME_HEADER = struct.Struct("!I")
+MAX_FRAME_SIZE = 1 << 20
+#maximum number of bytes given to a single send() call
+SEND_CHUNK_SIZE = 256 * 1024
+
+def frame(message):
+    """returns the frame that carries ``message`` (``bytes``)"""
+    return FRAME_HEADER.pack(len(message)) + message
+
+class FrameReader:
+    """Reassemble frames from a stream
+
+        :param buffer_size: (int) initial size of the reception buffer, it grows
+            if a frame does not fit
+
+        the stream is read with :meth:`read_from` (one ``recv_into`` per call, as
+        large as the free space of the buffer) or given with :meth:`feed`.
+        Both return the list of complete messages.
+    """
+    def __init__(self, buffer_size = 65536):
+        self.buffer = bytearray(buffer_size)
+        self.start = 0
+        self.end = 0
+
+    def _make_room(self, needed):
+        """make sure ``needed`` bytes can be written after ``self.end``"""
+        if len(self.buffer) - self.end >= needed:
+            return
+        pending = self.end - self.start
+        if pending + needed > len(self.buffer):
+            self.buffer.extend(bytearray(pending + needed - len(self.buffer)))
+        #move pending bytes to the beginning of the buffer
+        self.buffer[0:pending] = self.buffer[self.start:self.end]
+        self.start = 0
+        self.end = pending
+
+    def read_from(self, sock):
+        """Receive data from ``sock``
+
+            :returns: a list of messages (``bytes``), possibly empty
+            :raises: :exc:`ConnectionResetError` (the peer closed the connection),
+                :exc:`ValueError` (invalid frame) or the socket exceptions
+        """
+        self._make_room(FRAME_HEADER.size)
+        with memoryview(self.buffer) as view:
+            received = sock.recv_into(view[self.end:])
+        if received == 0:
+            raise ConnectionResetError("Connection closed by peer")
+        self.end += received
+        return self._messages()
+
+    def feed(self, data):
+        """Add ``data`` to the stream, returns the list of complete messages"""
+        self._make_room(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+        return self._messages()
+
+    def _messages(self):
+        messages = []
+        buffer = self.buffer
+        while self.end - self.start >= FRAME_HEADER.size:
+            length = FRAME_HEADER.unpack_from(buffer, self.start)[0]
+            if length > MAX_FRAME_SIZE:
+                raise ValueError("Frame too large (%d bytes)"%length)
+            frame_end = self.start + FRAME_HEADER.size + length
+            if frame_end > self.end:
+                #incomplete frame: make sure the buffer can hold it
+                self._make_room(frame_end - self.end)
+                break
+            messages.append(bytes(buffer[self.start + FRAME_HEADER.size:frame_end]))
+            self.start = frame_end
+        if self.start == self.end:
+            self.start = self.end = 0
+        return messages
+
+class Subscription:
+    """What a :class:`DiffusionClient` wants to receive
+
+        :param sids: (opt) list of device sids
+        :param models: (opt) list of device models (e.g. ``"weather.v2"``)
+        :param cmds: (opt) list of packet cmds (e.g. ``"report"``)
+        :param capabilities: (opt) list of capability names (keys of the packet ``data``)
+
+        a packet matches when it matches every given criterion, and a criterion
+        when the packet value is in its list. ``None`` or an empty list accepts everything.
+    """
+    FIELDS = ("sids", "models", "cmds", "capabilities")
+
+    def __init__(self, sids=None, models=None, cmds=None, capabilities=None):
+        self.sids = frozenset(sids or ())
+        self.models = frozenset(models or ())
+        self.cmds = frozenset(cmds or ())
+        self.capabilities = frozenset(capabilities or ())
+
+    @classmethod
+    def from_message(cls, message):
+        """create a Subscription from a decoded ``subscribe`` control message"""
+        return cls(**dict((field, message.get(field)) for field in cls.FIELDS))
+
+    def to_message(self):
+        """returns the ``subscribe`` control message (a dict) sent by the client"""
+        message = {"cmd": "subscribe"}
+        for field in self.FIELDS:
+            message[field] = sorted(getattr(self, field))
+        return message
+
+    def accepts_everything(self):
+        return not (self.sids or self.models or self.cmds or self.capabilities)
+
+    def matches(self, packet):
+        """``True`` if ``packet`` (a decoded packet) matches this subscription"""
+        data = packet.get("data")
+        capabilities = data.keys() if isinstance(data, dict) else ()
+        return ((not self.sids or packet.get("sid") in self.sids) and
+                (not self.models or packet.get("model") in self.models) and
+                (not self.cmds or packet.get("cmd") in self.cmds) and
+                (not self.capabilities or not self.capabilities.isdisjoint(capabilities)))
+
+class SubscriptionIndex:
+    """Find the subscribed clients that want a packet
+
+        clients are indexed by the values of each criterion of their :class:`Subscription`, so
+        :meth:`recipients` costs a few set operations per packet whatever the number of clients.
+        Results are cached per ``(sid, model, cmd, capabilities)`` until a subscription changes.
+    """
+    MAX_CACHE_SIZE = 4096
+
+    def __init__(self):
+        self.subscriptions = {}
+        self.unconstrained = dict((field, set()) for field in Subscription.FIELDS)
+        self.by_value = dict((field, {}) for field in Subscription.FIELDS)
+        self.cache = {}
+
+    def is_empty(self):
+        return len(self.subscriptions) == 0
+
+    def subscribe(self, client, subscription):
+        """set (or replace) the subscription of ``client``"""
+        self.unsubscribe(client)
+        self.subscriptions[client] = subscription
+        for field in Subscription.FIELDS:
+            values = getattr(subscription, field)
+            if not values:
+                self.unconstrained[field].add(client)
+            for value in values:
+                self.by_value[field].setdefault(value, set()).add(client)
+        self.cache.clear()
+
+    def unsubscribe(self, client):
+        subscription = self.subscriptions.pop(client, None)
+        if subscription is None:
+            return
+        for field in Subscription.FIELDS:
+            self.unconstrained[field].discard(client)
+            for value in getattr(subscription, field):
+                clients = self.by_value[field][value]
+                clients.discard(client)
+                if not clients:
+                    del(self.by_value[field][value])
+        self.cache.clear()
+
+    def _matching(self, field, values):
+        clients = set(self.unconstrained[field])
+        index = self.by_value[field]
+        for value in values:
+            clients.update(index.get(value, ()))
+        return clients
+
+    def recipients(self, packet):
+        """returns the set of subscribed clients that want ``packet`` (a decoded packet)"""
+        data = packet.get("data")
+        capabilities = tuple(sorted(data.keys())) if isinstance(data, dict) else ()
+        key = (packet.get("sid"), packet.get("model"), packet.get("cmd"), capabilities)
+        recipients = self.cache.get(key)
+        if recipients is None:
+            recipients = self._matching("sids", key[0:1])
+            recipients &= self._matching("models", key[1:2])
+            recipients &= self._matching("cmds", key[2:3])
+            recipients &= self._matching("capabilities", capabilities)
+            if len(self.cache) >= self.MAX_CACHE_SIZE:
+                self.cache.clear()
+            self.cache[key] = recipients = frozenset(recipients)
+        return recipients
+
+class StateSnapshot:
+    """Latest state of every device, sent to the clients when they connect
+
+        the ``data`` of every ``report`` and ``heartbeat`` packet is merged into the state
+        of its device, so the snapshot holds the latest value of each ``(sid, capability)``
+        and is updated in place, never rebuilt. A device state is sent as a single ``report``
+        packet with a ``"snapshot": true`` field, its frame is encoded at most once per change.
+    """
+    CMDS = ("report", "heartbeat")
+    RAW_CMDS = (b"report", b"heartbeat")
+
+    def __init__(self):
+        self.devices = collections.OrderedDict()  #sid -> [state packet, frame or None]
+
+    def __len__(self):
+        return len(self.devices)
+
+    def update(self, packet):
+        """merge a decoded packet into the state of its device, other cmds are ignored"""
+        data = packet.get("data")
+        sid = packet.get("sid")
+        if packet.get("cmd") not in self.CMDS or sid is None or not isinstance(data, dict) or not data:
+            return
+        entry = self.devices.get(sid)
+        if entry is None:
+            entry = self.devices[sid] = [{"cmd": "report", "sid": sid, "data": {}, "snapshot": True}, None]
+        state = entry[0]
+        for field in ("model", "short_id"):
+            if field in packet:
+                state[field] = packet[field]
+        state["data"].update(data)
+        entry[1] = None
+
+    def frames(self, subscription = None):
+        """returns the frames of the device states matching ``subscription`` (all of them when ``None``)"""
+        frames = []
+        for entry in self.devices.values():
+            state = entry[0]
+            if subscription is not None and not subscription.matches(state):
+                continue
+            if entry[1] is None:
+                #keep the gateway format: data is a json string
+                entry[1] = frame(codec.dumpb(dict(state, data = codec.dumps(state["data"]))))
+            frames.append(entry[1])
+        return frames
+
+class ReplayRing:
+    """The last messages sent by a server, numbered by a sequence number
+
+        :param size: (int) number of messages kept for the clients that resume
+
+        every message that is a json object is stamped with a ``"seq"`` field (its first
+        field). Sequence numbers start at the server start time in microseconds, so they
+        keep growing when the server restarts: a client never resumes from the numbers
+        of another server.
+    """
+    def __init__(self, size = 4096):
+        self.messages = collections.deque(maxlen = size)  #(seq, message, frame)
+        self.seq = int(time.time() * 1000000)
+
+    def stamp(self, message):
+        """number and keep ``message`` (``bytes``), returns ``(stamped message, its frame)``"""
+        self.seq += 1
+        if message[:1] == b"{" and message[1:2] != b"}":
+            message = b'{"seq":%d,'%self.seq + message[1:]
+        data = frame(message)
+        self.messages.append((self.seq, message, data))
+        return message, data
+
+    def since(self, seq):
+        """the ``(message, frame)`` sent after ``seq``, ``None`` if some of them are not kept anymore"""
+        if seq == self.seq:
+            return []
+        if seq > self.seq or not self.messages or self.messages[0][0] > seq + 1:
+            return None
+        start = seq + 1 - self.messages[0][0]
+        return [item[1:] for item in itertools.islice(self.messages, start, None)]
+
+#the seq field stamped by ReplayRing.stamp
+_SEQ_RE = re.compile(br'\{\s*"seq"\s*:\s*([0-9]+)')
+
 class DiffusionClient:
-    def __init__(self, callback, server_address, server_port = DEFAULT_PORT):
+    """Receive the packets of a :class:`DiffusionServer`
+
+        :param callback: a function ``cb(message, "client_socket")`` called once per received message
+        :param server_address: the server host
+        :param server_port: the server port
+        :param reactor: (opt) a :class:`reactor.Reactor`. When ``None``, the client runs its own
+            reactor in a dedicated thread
+        :param subscription: (opt) a :class:`Subscription` sent to the server on connection.
+            The server then only sends the matching packets (all of them when ``None``),
+            starting with the latest state of the devices (see :class:`StateSnapshot`)
+        :param encoding: (str) the encoding asked to the server, see :mod:`diffusion_codec`
+        :param compression: (opt) the compression asked to the server, see :mod:`diffusion_codec`
+
+        ``callback`` always receives json messages. The server switches to the requested
+        encoding when it acknowledges it, an older server keeps sending json.
+
+        :param reconnect: (bool) when the connection is lost, reconnect with an exponential
+            backoff (from ``min_backoff`` to ``max_backoff`` seconds) and resume after the
+            last received ``seq`` (see :class:`ReplayRing`). The server sends its snapshot
+            instead when the missed messages are not in its ring anymore.
+            Without ``reconnect``, or if the first connection fails, the client stops and
+            :meth:`check_and_raise` raises the error.
+        :param unix_path: (opt) connect to the unix domain socket of a server on the same
+            host instead of ``server_address:server_port``
+    """
+    def __init__(self, callback, server_address, server_port = DEFAULT_PORT, reactor = None, subscription = None,
+                 encoding = "json", compression = None, reconnect = True, min_backoff = 0.1, max_backoff = 30.,
+                 unix_path = None):
+        diffusion_codec._check(encoding, compression)
         self.server_address = server_address
+        self.subscription = subscription
+        self.encoding = encoding
+        self.compression = compression
+        self.decoder = None
         self.server_port = server_port
         self.callback = callback
+        self.reconnect = reconnect
+        self.unix_path = unix_path
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.last_seq = None
+        self.reconnections = 0
         self.fatal_event = threading.Event()
         self.exception_queue = Queue.Queue()
+        self.own_reactor = reactor is None
+        self.reactor = Reactor() if reactor is None else reactor
+        self.sock = None
+        self.client_thread = None
+        self.reconnect_thread = None
+        self.reader = FrameReader()
 
-        def client():
-            import select
-            timeout = 0.2
-            log.debug("Starting client thread")
-            try:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.setblocking(1)
-                conninfo = (self.server_address, self.server_port)
-                log.info("Connecting to %s:%d"%conninfo)
-                sock.connect(conninfo)
-                incoming = [sock]
-                while not self.fatal_event.is_set():
-                    #wait timeout for the socket to be readable
-                    readable, writable, exceptional = select.select(incoming,[],[],timeout)
-                    if sock in readable:
-                        message = sock.recv(1024)
-                        if len(message) == 0:
-                            continue
-                        log.debug("Received %d bytes"%(len(message)))
-                        try:
-                            self.callback(message,"client_socket")
-                        except Exception as e:
-                            log.error("Error while receiving: %s"%str(e))
-                            log.exception("receiving")
-                            #self.exception_queue.put(e)
-
-
-                log.info("Exiting client on request")
+        log.debug("Starting client")
+        try:
+            self.sock = self._connect()
+            self.reactor.register(self.sock, self._on_readable)
+        except Exception as e:
+            self._fatal(e)
+
+        if self.own_reactor:
+            self.client_thread = threading.Thread(target=self._run,name="client_thread")
+            self.client_thread.start()
+
+    def _connect(self):
+        """connect to the server and send the control messages, returns the socket"""
+        if self.unix_path is not None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            conninfo = self.unix_path
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            conninfo = (self.server_address, self.server_port)
+        try:
+            sock.setblocking(1)
+            log.info("Connecting to %r"%(conninfo,))
+            sock.connect(conninfo)
+            if (self.encoding, self.compression) != ("json", None):
+                sock.sendall(frame(codec.dumpb(diffusion_codec.negotiation(self.encoding, self.compression))))
+            #an empty subscription accepts everything, the server sends its snapshot when it receives it
+            subscription = self.subscription if self.subscription is not None else Subscription()
+            message = subscription.to_message()
+            if self.last_seq is not None:
+                message["resume"] = self.last_seq
+            sock.sendall(frame(codec.dumpb(message)))
+        except Exception:
+            sock.close()
+            raise
+        return sock
 
+    def _run(self):
+        if not self.fatal_event.is_set():
+            self.reactor.run_forever()
+        log.info("Exiting client on request")
+        self.reactor.close()
+
+    def _fatal(self, exception):
+        self.exception_queue.put(exception)
+        log.error("Exiting connection because of %s"%str(exception))
+        self.fatal_event.set()
+        self._close()
+
+    def _connection_lost(self, exception):
+        """called from the reactor thread when the connection fails"""
+        if self.fatal_event.is_set():
+            #stopped on purpose, not an error
+            self._close()
+            return
+        if not self.reconnect:
+            self._fatal(exception)
+            return
+        log.warning("Connection lost (%s), reconnecting"%str(exception))
+        self.reactor.unregister(self.sock)
+        try:
+            self.sock.close()
+        except:
+            pass
+        self.reconnect_thread = threading.Thread(target=self._reconnect, name="client_reconnect_thread")
+        self.reconnect_thread.daemon = True
+        self.reconnect_thread.start()
+
+    def _reconnect(self):
+        """connect again, waiting ``min_backoff`` then twice as long after each failure"""
+        backoff = self.min_backoff
+        while not self.fatal_event.wait(backoff):
+            try:
+                sock = self._connect()
             except Exception as e:
-                self.exception_queue.put(e)
-                log.error("Exiting connection because of %s"%str(e))
-                self.fatal_event.set()
+                log.info("Reconnection failed (%s), next try in %.1fs"%(str(e), min(backoff * 2, self.max_backoff)))
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+            self.reactor.call_soon(self._attach, sock)
+            return
+
+    def _attach(self, sock):
+        """watch the new connection, called from the reactor thread"""
+        if self.fatal_event.is_set():
+            sock.close()
+            return
+        self.sock = sock
+        self.reader = FrameReader()
+        self.decoder = None
+        self.reconnections += 1
+        self.reactor.register(sock, self._on_readable)
+        log.info("Reconnected, resuming after seq %r"%self.last_seq)
+
+    def _close(self):
+        if self.sock is not None:
+            self.reactor.unregister(self.sock)
             try:
-                sock.close()
+                self.sock.close()
             except:
                 pass
-        self.client_thread = threading.Thread(target=client,name="client_thread")
-        self.client_thread.start()
+        if self.own_reactor:
+            self.reactor.stop()
+
+    def _on_readable(self, sock, mask):
+        try:
+            messages = self.reader.read_from(sock)
+        except Exception as e:
+            self._connection_lost(e)
+            return
+        log.debug("Received %d messages", len(messages))
+        for message in messages:
+            try:
+                if self.decoder is not None:
+                    message = self.decoder.decode(message)
+                elif self.encoding != "json" or self.compression is not None:
+                    if codec.raw_cmd(message) == b"encoding":
+                        control = codec.loads(message)
+                        log.info("Server switched to %r"%(control,))
+                        self.decoder = diffusion_codec.StreamDecoder(control["encoding"], control["compression"])
+                        continue
+                match = _SEQ_RE.match(message)
+                if match is not None:
+                    self.last_seq = int(match.group(1))
+            except Exception as e:
+                #the stream can't be decoded anymore
+                self._connection_lost(e)
+                return
+            try:
+                self.callback(message,"client_socket")
+            except Exception as e:
+                log.error("Error while receiving: %s"%str(e))
+                log.exception("receiving")
 
     def __enter__(self):
         return self
     def __exit__(self, exception_type, exception_value, traceback):
-        self.fatal_event.set()
+        self._shutdown()
+
+    def _shutdown(self):
+        if not self.fatal_event.is_set():
+            self.fatal_event.set()
+            self.reactor.call_soon(self._close)
 
     def stop(self):
-        self.fatal_event.set()
+        self._shutdown()
         self.check_and_raise()
 
     def is_alive(self):
@@ -76,65 +499,504 @@ class DiffusionClient:
             raise(self.exception_queue.get())
         return True
 
+def _decode(message, index, snapshot):
+    """decode ``message`` (raw packet) if the subscriptions ``index`` or the ``snapshot`` need it
+
+        returns ``None`` when they do not, or when ``message`` is not an aqara packet
+    """
+    if index.is_empty() and (snapshot is None or codec.raw_cmd(message) not in StateSnapshot.RAW_CMDS):
+        return None
+    try:
+        packet = codec.decode_packet(message)
+    except ValueError:
+        return None
+    return packet
+
+def _read_control(client, message):
+    """decode a control message (``bytes``) sent by ``client``, ``None`` if it is invalid"""
+    try:
+        control = codec.loads(message)
+        if control.get("cmd") not in ("subscribe", "encoding"):
+            raise ValueError("unknown control message")
+        if control["cmd"] == "encoding":
+            diffusion_codec._check(control.get("encoding"), control.get("compression"))
+            control = diffusion_codec.negotiation(control.get("encoding"), control.get("compression"))
+        return control
+    except Exception as e:
+        log.warning("Invalid control message %r from %r: %r"%(message, client.address, e))
+        return None
+
+def _wanted(subscription, message):
+    """``True`` if a client with ``subscription`` (or ``None``) wants ``message`` (raw packet)"""
+    if subscription is None or subscription.accepts_everything():
+        return True
+    try:
+        packet = codec.decode_packet(message)
+    except ValueError:
+        return False
+    return subscription.matches(packet)
+
+def _recipients(index, packet):
+    """the subscribed clients of ``index`` that want ``packet`` (decoded packet or ``None``)"""
+    if packet is None or index.is_empty():
+        #not an aqara packet, only for clients without subscription
+        return ()
+    return index.recipients(packet)
+
+def _coalesce_keys(message):
+    """the ``(sid, cmd, capability)`` carried by ``message`` (raw packet), an empty set when it
+        has no sid. A packet without data is keyed with a ``None`` capability
+    """
+    if not codec.raw_sid(message):
+        return set()
+    try:
+        packet = codec.decode_packet(message)
+    except ValueError:
+        return set()
+    sid, cmd, data = packet.get("sid"), packet.get("cmd"), packet.get("data")
+    if isinstance(data, dict) and data:
+        return {(sid, cmd, capability) for capability in data}
+    return {(sid, cmd, None)}
+
+class _ClientConnection:
+    """State of a client of :class:`DiffusionServer`: its outbound queue and counters"""
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.queue = collections.deque()  #(enqueue_time, frame)
+        self.head_offset = 0  #bytes of queue[0] already sent
+        self.in_flight = 0  #queued messages in the send in progress, see DiffusionServer._flush
+        self.queued_bytes = 0
+        self.max_queued_bytes = 0
+        self.writing = False
+        self.closing = False
+        self.sent_messages = 0
+        self.sent_bytes = 0
+        self.coalesced_messages = 0
+        self.max_lag = 0.
+        self.reader = FrameReader(4096)
+        self.subscribed = False
+        #until the client subscribes (or the handshake times out), live messages are not queued
+        self.handshaking = True
+        self.held = []  #(message, frame) received while handshaking, kept when there is no snapshot
+        self.held_bytes = 0
+        self.encoder = None
+        self.batch_pending = False
+
+    def encode(self, message, data):
+        """the bytes to queue for ``message``, ``data`` being its json frame"""
+        if self.encoder is None:
+            return data
+        return frame(self.encoder.encode(message))
+
+    def lag(self, now):
+        """age in seconds of the oldest message waiting to be sent"""
+        if not self.queue:
+            return 0.
+        return now - self.queue[0][0]
+
+    def coalesce(self):
+        """keep only the newest queued value of each (sid, cmd, capability)
+
+            a message is dropped when every capability of its ``data`` is in a newer message
+            of its device with the same cmd: the separate temperature, humidity and pressure
+            reports of a sensor are all kept, and so is a snapshot merging them. The messages
+            of the send in progress and a partially sent message are always kept: the client
+            already has their beginning
+        """
+        queue = self.queue
+        sending = collections.deque()
+        for _ in range(min(max(self.in_flight, 1 if self.head_offset else 0), len(queue))):
+            sending.append(queue.popleft())
+        newer = set()
+        kept = collections.deque()
+        for item in reversed(queue):
+            keys = _coalesce_keys(item[1][FRAME_HEADER.size:])
+            if keys:
+                if keys <= newer:
+                    continue
+                newer |= keys
+            kept.appendleft(item)
+        self.coalesced_messages += len(queue) - len(kept)
+        kept.extendleft(reversed(sending))
+        self.queue = kept
+        self.queued_bytes = sum(len(item[1]) for item in kept) - self.head_offset
+
+    def stats(self, now):
+        return {"address": self.address,
+                "queued_messages": len(self.queue),
+                "queued_bytes": self.queued_bytes,
+                "max_queued_bytes": self.max_queued_bytes,
+                "lag": self.lag(now),
+                "max_lag": max(self.max_lag, self.lag(now)),
+                "sent_messages": self.sent_messages,
+                "sent_bytes": self.sent_bytes,
+                "coalesced_messages": self.coalesced_messages,
+                "encoding": "json" if self.encoder is None else self.encoder.encoding,
+                "compression": None if self.encoder is None else self.encoder.compression}
+
 class DiffusionServer:
-    def __init__(self, server_address = ("",DEFAULT_PORT)):
+    """Forward messages to every connected TCP client, see :func:`frame`
+
+        :param server_address: (host, port) to listen to
+        :param reactor: (opt) a :class:`reactor.Reactor` that will watch the listening
+            and client sockets. When ``None``, the server runs its own reactor in a
+            dedicated thread
+        :param max_queued_bytes: (int) size of the outbound queue of each client
+        :param slow_client_policy: (str) what happens when the queue of a client is full:
+            - ``"disconnect"``: the client is disconnected
+            - ``"coalesce"``: only the newest queued value of each ``(sid, cmd, capability)`` is kept,
+              the client is disconnected if it is still full (or if it uses another
+              encoding than json, see :mod:`diffusion_codec`)
+
+        :meth:`send_message` only queues the message: sockets are written by the reactor
+        when they are writable, so a slow client never delays the caller or the other
+        clients. See :meth:`client_stats` for the per client lag.
+
+        Clients can send a :class:`Subscription` to only receive some packets, and ask for
+        a more compact encoding of the messages (see :mod:`diffusion_codec`).
+
+        Nothing is sent to a new client until it subscribes (a :class:`DiffusionClient` always
+        does), or until ``handshake_timeout`` seconds for the clients that never do. Then, with
+        ``snapshot`` enabled, it first receives the latest state of the devices (see
+        :class:`StateSnapshot`) filtered by its subscription, then the live packets. Without
+        snapshot, it receives the messages sent since it connected.
+
+        With ``replay_size``, messages are numbered and the last ``replay_size`` ones are kept
+        (see :class:`ReplayRing`): a client that reconnects receives the messages it missed
+        instead of the snapshot.
+
+        With a ``batch_delay`` (in seconds, e.g. ``0.005``), the messages queued for an idle
+        client are written together, with a single ``send``, ``batch_delay`` after the first
+        one or as soon as ``batch_bytes`` are queued. Client sockets then use ``TCP_NODELAY``,
+        so the batching window is the only delay added. See :meth:`batch_stats`.
+
+        Consumers running on the same host can avoid TCP: with ``unix_path`` the server also
+        listens to a unix domain socket (see the ``unix_path`` of :class:`DiffusionClient`),
+        with ``shm_name`` it also writes every message to a shared memory ring of ``shm_size``
+        bytes (see :mod:`diffusion_shm`).
+    """
+    POLICIES = ("disconnect", "coalesce")
+
+    def __init__(self, server_address = ("",DEFAULT_PORT), reactor = None,
+                 max_queued_bytes = 1024 * 1024, slow_client_policy = "disconnect", snapshot = True,
+                 replay_size = 4096, batch_delay = 0., batch_bytes = 16 * 1024,
+                 unix_path = None, shm_name = None, shm_size = 4 * 1024 * 1024, handshake_timeout = 0.2):
+        if slow_client_policy not in self.POLICIES:
+            raise ValueError("Unknown policy %r not in %r"%(slow_client_policy,self.POLICIES))
+        self.max_queued_bytes = int(max_queued_bytes)
+        self.slow_client_policy = slow_client_policy
         self.active_connections = {}
+        self.subscriptions = SubscriptionIndex()
+        self.snapshot = StateSnapshot() if snapshot else None
+        self.replay = ReplayRing(replay_size) if replay_size else None
+        self.batch_delay = float(batch_delay)
+        self.batch_bytes = int(batch_bytes)
+        self.handshake_timeout = float(handshake_timeout)
+        self.metrics = Metrics()
+        self.disconnected_slow_clients = 0
         self.server_thread = None
         self.fatal_event = threading.Event()
         self.exception_queue = Queue.Queue()
         self.connections_lock = threading.Lock()
         self.server_started = threading.Event()
+        self.own_reactor = reactor is None
+        self.reactor = Reactor() if reactor is None else reactor
+        self.sock = None
+        self.unix_path = unix_path
+        self.unix_sock = None
+        self.shm_ring = None
 
+        log.debug("Starting server")
+        try:
+            # Create a TCP/IP socket
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setblocking(0)
+            #restart without waiting for the connections of the previous server to time out
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            # Bind the socket to the address given on the command line
+            self.sock.bind(server_address)
+            log.info('starting server on %s port %s' % self.sock.getsockname())
+            self.sock.listen(128)
+            self.reactor.register(self.sock, self._on_accept)
+            if unix_path is not None:
+                self.unix_sock = self._listen_unix(unix_path)
+                self.reactor.register(self.unix_sock, self._on_accept)
+            if shm_name is not None:
+                self.shm_ring = diffusion_shm.SharedRing(shm_name, shm_size)
+                log.info('writing to shared memory %s'%shm_name)
+            self.server_started.set()
+        except Exception as e:
+            self._fatal(e)
 
-        def server():
-            import select
-            timeout = 0.2
-            log.debug("Starting server thread with timeout %.2f"%timeout)
+        if self.own_reactor:
+            self.server_thread = threading.Thread(target=self._run,name="server_thread")
+            self.server_thread.start()
 
-            try:
-                # Create a TCP/IP socket
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.setblocking(0)
-                # Bind the socket to the address given on the command line
-                sock.bind(server_address)
-                log.info('starting server on %s port %s' % sock.getsockname())
-                sock.listen(1)
-                self.server_started.set()
-                incoming = [ sock ]
-                while not self.fatal_event.is_set():
-                    readable, writable, exceptional = select.select(incoming,[],[],timeout)
-                    if sock in readable:
-                        connection, client_address = sock.accept()
-                        log.info("New connection %r %r"%(connection,client_address))
-                        with self.connections_lock:
-                            self.active_connections[connection]=client_address
-            except Exception as e:
-                self.fatal_event.set()
-                log.error("Exception: server exiting")
-                self.exception_queue.put(e)
-                self.server_started.clear()
+    def _listen_unix(self, path):
+        #remove the socket file left by a previous server
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        sock.bind(path)
+        log.info('starting server on %s' % path)
+        sock.listen(16)
+        return sock
 
+    def _run(self):
+        if not self.fatal_event.is_set():
+            self.reactor.run_forever()
+        log.info("Exit requested: server exiting")
+        self.reactor.close()
+
+    def _fatal(self, exception):
+        self.fatal_event.set()
+        log.error("Exception: server exiting")
+        self.exception_queue.put(exception)
+        self._close()
+
+    def _close(self):
+        self.server_started.clear()
+        for sock in (self.sock, self.unix_sock):
+            if sock is not None:
+                self.reactor.unregister(sock)
+                try:
+                    sock.close()
+                except:
+                    pass
+        if self.unix_sock is not None:
             try:
-                self.server_started.clear()
-                sock.close()
-            except:
+                os.unlink(self.unix_path)
+            except OSError:
                 pass
-            log.info("Exit requested: server exiting")
+        with self.connections_lock:
+            if self.shm_ring is not None:
+                self.shm_ring.close()
+                self.shm_ring = None
+            connections = list(self.active_connections.keys())
+        for conn in connections:
+            self._remove_connection(conn)
+        if self.own_reactor:
+            self.reactor.stop()
+
+    def _on_accept(self, sock, mask):
+        try:
+            connection, client_address = sock.accept()
+        except BlockingIOError:
+            return
+        except Exception as e:
+            self._fatal(e)
+            return
+        connection.setblocking(0)
+        if self.batch_delay and sock is self.sock:
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        log.info("New connection %r %r"%(connection,client_address))
+        with self.connections_lock:
+            self.active_connections[connection] = _ClientConnection(connection, client_address)
+        self.reactor.register(connection, self._on_client_event)
+        self.reactor.call_later(self.handshake_timeout, self._end_handshake, connection)
+
+    def _end_handshake(self, conn):
+        """start sending to a client that did not subscribe, called from the reactor thread"""
+        with self.connections_lock:
+            client = self.active_connections.get(conn)
+            if client is not None and client.handshaking and not client.closing:
+                log.info("Client %r did not subscribe, sending everything"%(client.address,))
+                self._start(conn, client, None, time.time())
+
+    def _start(self, conn, client, seq, now):
+        """end the handshake of ``client``: queue the replay after ``seq`` if it is available,
+            else the snapshot, else the messages held since it connected. Must be called with
+            ``connections_lock`` held
+        """
+        client.handshaking = False
+        held, client.held = client.held, []
+        client.held_bytes = 0
+        if self._queue_replay(conn, client, seq, now):
+            return
+        if self.snapshot is not None:
+            self._queue_snapshot(conn, client, now)
+            return
+        subscription = self.subscriptions.subscriptions.get(client)
+        for message, data in held:
+            if client.closing:
+                break
+            if _wanted(subscription, message):
+                self._queue(conn, client, client.encode(message, data), now)
+
+    def _hold(self, conn, client, message, data):
+        """keep a message for a client that did not subscribe yet, must be called with
+            ``connections_lock`` held
+        """
+        if self.snapshot is not None:
+            #the snapshot will hold the state
+            return
+        client.held.append((message, data))
+        client.held_bytes += len(data)
+        if client.held_bytes > self.max_queued_bytes:
+            log.warning("Client %r did not subscribe (%d bytes held), disconnecting"%(client.address,client.held_bytes))
+            client.closing = True
+            self.reactor.call_soon(self._remove_connection, conn)
+
+    def _on_client_event(self, conn, mask):
+        if mask & EVENT_READ:
+            client = self.active_connections.get(conn)
+            try:
+                messages = client.reader.read_from(conn)
+            except (BlockingIOError, InterruptedError):
+                messages = []
+            except Exception:
+                #client hung up
+                self._remove_connection(conn)
+                return
+            for message in messages:
+                with self.connections_lock:
+                    self._on_control(conn, client, message)
+        if mask & EVENT_WRITE:
+            self._flush(conn)
+
+    def _on_control(self, conn, client, message):
+        """handle a control message, must be called with ``connections_lock`` held"""
+        control = _read_control(client, message)
+        now = time.time()
+        if control is None:
+            return
+        if control["cmd"] == "encoding":
+            #acknowledged in the current encoding, the following messages use the new one
+            reply = codec.dumpb(control)
+            self._queue(conn, client, client.encode(reply, frame(reply)), now)
+            if (control["encoding"], control["compression"]) != ("json", None):
+                client.encoder = diffusion_codec.StreamEncoder(control["encoding"], control["compression"])
+            log.info("Client %r switched to %r"%(client.address, control))
+            return
+        self.subscriptions.subscribe(client, Subscription.from_message(control))
+        client.subscribed = True
+        log.info("Client %r subscribed to %r"%(client.address, control))
+        if client.handshaking:
+            self._start(conn, client, control.get("resume"), now)
+
+    def _want_write(self, conn):
+        """watch ``conn`` for writability, called from the reactor thread"""
+        client = self.active_connections.get(conn)
+        if client is None or not client.queue:
+            #the batch was already written
+            return
+        client.batch_pending = False
+        if self.reactor.is_registered(conn):
+            self.reactor.modify(conn, self._on_client_event, EVENT_READ | EVENT_WRITE)
 
-        self.server_thread = threading.Thread(target=server,name="server_thread")
-        self.server_thread.start()
+    def _flush(self, conn):
+        """write as much of the client queue as the socket accepts, called from the reactor thread"""
+        with self.connections_lock:
+            client = self.active_connections.get(conn)
+            if client is None:
+                return
+            chunks = []
+            size = -client.head_offset
+            for item in client.queue:
+                chunks.append(item[1])
+                size += len(item[1])
+                if size >= SEND_CHUNK_SIZE:
+                    break
+            if chunks and client.head_offset:
+                chunks[0] = chunks[0][client.head_offset:]
+            data = b"".join(chunks)
+            #send_message may coalesce the queue while it is sent, these messages must stay
+            client.in_flight = len(chunks)
+            first_enqueue_time = client.queue[0][0] if client.queue else None
+        send_time = time.time()
+        try:
+            sent = conn.send(data)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except Exception:
+            log.exception("sending...")
+            self._remove_connection(conn)
+            return
+        now = time.time()
+        with self.connections_lock:
+            client.in_flight = 0
+            #remove fully sent messages, remember how much of a partially sent one was sent
+            remaining = sent
+            batch_messages = 0
+            while remaining and client.queue:
+                enqueue_time, head = client.queue[0]
+                client.max_lag = max(client.max_lag, now - enqueue_time)
+                unsent = len(head) - client.head_offset
+                if unsent <= remaining:
+                    client.queue.popleft()
+                    client.head_offset = 0
+                    client.sent_messages += 1
+                    batch_messages += 1
+                    remaining -= unsent
+                else:
+                    client.head_offset += remaining
+                    remaining = 0
+            client.queued_bytes -= sent
+            client.sent_bytes += sent
+            if sent:
+                counters = self.metrics.counters
+                counters["batches"] += 1
+                counters["batched_messages"] += batch_messages
+                counters["batched_bytes"] += sent
+                self.metrics.histogram("batch_delay").observe(int((send_time - first_enqueue_time) * 1e9))
+            if not client.queue:
+                client.writing = False
+                self.reactor.modify(conn, self._on_client_event, EVENT_READ)
+
+    def _remove_connection(self, conn):
+        """remove a client connection, must be called from the reactor thread"""
+        self.reactor.unregister(conn)
+        with self.connections_lock:
+            client = self.active_connections.pop(conn, None)
+            if client is not None:
+                self.subscriptions.unsubscribe(client)
+        if client is not None:
+            log.info("Removing connection to %r"%(client.address,))
+        try:
+            conn.close()
+        except:
+            log.exception("removing connection")
 
     def __enter__(self):
         return self
     def __exit__(self, exception_type, exception_value, traceback):
-        self.fatal_event.set()
+        self._shutdown()
 
     def has_clients(self):
         self.check_and_raise()
         return len(self.active_connections.keys()) != 0
 
+    def client_stats(self):
+        """returns a list of dicts, one per client, with its ``address``, the number of
+            ``queued_messages`` and ``queued_bytes`` (and ``max_queued_bytes`` since it connected),
+            its ``lag`` (age in seconds of the oldest queued message) and ``max_lag``,
+            ``sent_messages``, ``sent_bytes`` and ``coalesced_messages``
+        """
+        now = time.time()
+        with self.connections_lock:
+            return [client.stats(now) for client in self.active_connections.values()]
+
+    def batch_stats(self):
+        """returns the number of ``batches`` (``send`` calls), the mean ``messages_per_batch``
+            and ``bytes_per_batch`` and the ``delay`` summary (see :meth:`aqara_metrics.Histogram.summary`):
+            time between the queuing of the first message of a batch and its ``send``
+        """
+        counters = self.metrics.counters
+        batches = counters["batches"]
+        return {"batches": batches,
+                "messages_per_batch": counters["batched_messages"] / float(batches) if batches else 0.,
+                "bytes_per_batch": counters["batched_bytes"] / float(batches) if batches else 0.,
+                "delay": self.metrics.histogram("batch_delay").summary()}
+
+    def _shutdown(self):
+        if not self.fatal_event.is_set():
+            self.fatal_event.set()
+            self.reactor.call_soon(self._close)
+
     def stop(self):
-        self.fatal_event.set()
+        self._shutdown()
         self.check_and_raise()
 
     def is_started(self):
@@ -149,49 +1011,324 @@ class DiffusionServer:
             raise(self.exception_queue.get())
         return True
 
+    def _queue(self, conn, client, data, now):
+        """queue a frame for ``client``, must be called with ``connections_lock`` held"""
+        client.queue.append((now, data))
+        client.queued_bytes += len(data)
+        if (client.queued_bytes > self.max_queued_bytes and self.slow_client_policy == "coalesce" and
+            client.encoder is None):
+            #encoded messages depend on the previous ones, they can't be dropped
+            client.coalesce()
+        client.max_queued_bytes = max(client.max_queued_bytes, client.queued_bytes)
+        if client.queued_bytes > self.max_queued_bytes:
+            log.warning("Client %r is too slow (%d bytes queued), disconnecting"%(client.address,client.queued_bytes))
+            client.closing = True
+            self.disconnected_slow_clients += 1
+            self.reactor.call_soon(self._remove_connection, conn)
+        elif not client.writing:
+            client.writing = True
+            if self.batch_delay and client.queued_bytes < self.batch_bytes:
+                client.batch_pending = True
+                self.reactor.call_later(self.batch_delay, self._want_write, conn)
+            else:
+                self.reactor.call_soon(self._want_write, conn)
+        elif client.batch_pending and client.queued_bytes >= self.batch_bytes:
+            #the batch is full, write it now
+            client.batch_pending = False
+            self.reactor.call_soon(self._want_write, conn)
+
+    def _queue_snapshot(self, conn, client, now):
+        """queue the snapshot for ``client``, must be called with ``connections_lock`` held"""
+        for data in self.snapshot.frames(self.subscriptions.subscriptions.get(client)):
+            if client.closing:
+                break
+            self._queue(conn, client, client.encode(data[FRAME_HEADER.size:], data), now)
+
+    def _queue_replay(self, conn, client, seq, now):
+        """queue the messages sent after ``seq`` for a client that resumes, must be called
+            with ``connections_lock`` held. Returns ``False`` if they are not all in the ring
+        """
+        if seq is None or self.replay is None:
+            return False
+        messages = self.replay.since(seq)
+        if messages is None:
+            log.info("Client %r can't resume after seq %r, sending the snapshot"%(client.address, seq))
+            return False
+        subscription = self.subscriptions.subscriptions.get(client)
+        for message, data in messages:
+            if client.closing:
+                break
+            if _wanted(subscription, message):
+                self._queue(conn, client, client.encode(message, data), now)
+        log.info("Client %r resumed after seq %r, %d messages replayed"%(client.address, seq, len(messages)))
+        return True
+
     def send_message(self,message):
+        """Queue ``message`` (``bytes``) for every client (thread safe)"""
         self.check_and_raise()
+        now = time.time()
         with self.connections_lock:
-            connections = self.active_connections.keys()
-        for conn in connections:
-            try:
-                log.debug("Sending [%s] to %r",message,self.active_connections[conn])
-                conn.sendall(message)
-            except:
-                log.exception("sending...")
-                with self.connections_lock:
-                    try:
-                        connection_infos = self.active_connections[conn]
-                        del(self.active_connections[conn])
-                        log.info("Removing connection to %r %r"%connection_infos)
-                        conn.close()
-                    except:
-                        log.exception("removing connection")
+            if self.replay is not None:
+                message, data = self.replay.stamp(message)
+            else:
+                data = frame(message)
+            if self.shm_ring is not None:
+                try:
+                    self.shm_ring.write(message)
+                except ValueError as e:
+                    log.warning("Not written to shared memory: %s"%e)
+            packet = _decode(message, self.subscriptions, self.snapshot)
+            recipients = _recipients(self.subscriptions, packet)
+            for conn, client in self.active_connections.items():
+                if client.closing:
+                    continue
+                if client.handshaking:
+                    self._hold(conn, client, message, data)
+                    continue
+                if client.subscribed and client not in recipients:
+                    continue
+                log.debug("Queuing [%s] to %r",message,client.address)
+                self._queue(conn, client, client.encode(message, data), now)
+            if packet is not None and self.snapshot is not None:
+                self.snapshot.update(packet)
 
-if __name__ == "__main__":
-    logging.basicConfig(level=logging.DEBUG)
-    log = logging.getLogger(__name__)
-    server = DiffusionServer()
-    for i in range(10):
+class _AsyncClientConnection(_ClientConnection):
+    """State of a client of :class:`AsyncDiffusionServer`"""
+    def __init__(self, writer, address):
+        _ClientConnection.__init__(self, writer, address)
+        self.ready = asyncio.Event()
+        self.task = None
+
+class AsyncDiffusionServer:
+    """asyncio version of :class:`DiffusionServer`
+
+        :param server_address: (host, port) to listen to
+        :param backlog: (int) size of the accept queue, so that bursts of connections are not refused
+        :param max_queued_bytes: (int) size of the outbound queue of each client, a client
+            is disconnected when its queue is full
+        :param snapshot: (bool) send the latest state of the devices to new clients,
+            see :class:`DiffusionServer`
+        :param replay_size: (int) number of messages kept for the clients that resume,
+            see :class:`DiffusionServer`
+        :param handshake_timeout: (float) time in seconds a new client has to subscribe before
+            it gets the snapshot and the live packets, see :class:`DiffusionServer`
+
+        the server must be started from a running event loop with ``await server.start()``,
+        :meth:`send_message` must be called from that loop. It never blocks: each client has
+        a writer task that sends its whole queue at once and waits for the transport to
+        drain before the next write, so a slow client only grows its own queue.
+        Clients can send a :class:`Subscription` to only receive some packets.
+    """
+    def __init__(self, server_address = ("",DEFAULT_PORT), backlog = 1024, max_queued_bytes = 1024 * 1024,
+                 snapshot = True, replay_size = 4096, handshake_timeout = 0.2):
+        self.server_address = server_address
+        self.handshake_timeout = float(handshake_timeout)
+        self.backlog = int(backlog)
+        self.max_queued_bytes = int(max_queued_bytes)
+        self.active_connections = {}
+        self.subscriptions = SubscriptionIndex()
+        self.snapshot = StateSnapshot() if snapshot else None
+        self.replay = ReplayRing(replay_size) if replay_size else None
+        self.disconnected_slow_clients = 0
+        self.server = None
+
+    async def start(self):
+        host, port = self.server_address
+        self.server = await asyncio.start_server(self._handle_client, host or None, port, backlog=self.backlog)
+        log.info('starting server on %s port %s' % self.server.sockets[0].getsockname()[:2])
+        return self
+
+    def port(self):
+        """the port the server listens to (useful when started on port 0)"""
+        return self.server.sockets[0].getsockname()[1]
+
+    async def _handle_client(self, reader, writer):
+        client_address = writer.get_extra_info("peername")
+        log.info("New connection %r"%(client_address,))
+        client = _AsyncClientConnection(writer, client_address)
+        self.active_connections[writer] = client
+        client.task = asyncio.ensure_future(self._write_loop(client))
+        handshake_timer = asyncio.get_running_loop().call_later(self.handshake_timeout, self._end_handshake, writer)
         try:
-            if not server.is_started():
-                import time
-                time.sleep(0.1)
-        except:
-            server.stop()
+            #clients only send control messages
+            while True:
+                data = await reader.read(4096)
+                if len(data) == 0:
+                    break
+                for message in client.reader.feed(data):
+                    self._on_control(writer, client, message)
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            handshake_timer.cancel()
+            self._remove(writer)
+
+    def _end_handshake(self, writer):
+        """see :meth:`DiffusionServer._end_handshake`"""
+        client = self.active_connections.get(writer)
+        if client is not None and client.handshaking:
+            log.info("Client %r did not subscribe, sending everything"%(client.address,))
+            self._start(writer, client, None, time.time())
+
+    def _start(self, writer, client, seq, now):
+        """see :meth:`DiffusionServer._start`"""
+        client.handshaking = False
+        held, client.held = client.held, []
+        client.held_bytes = 0
+        if self._queue_replay(writer, client, seq, now):
+            return
+        if self.snapshot is not None:
+            self._queue_snapshot(writer, client, now)
+            return
+        subscription = self.subscriptions.subscriptions.get(client)
+        for message, data in held:
+            if _wanted(subscription, message) and not self._queue(writer, client, client.encode(message, data), now):
+                break
 
-    def print_me(message):
-        log.info("Message received:[%s]"%message)
-    client = DiffusionClient(print_me,"localhost")
+    def _hold(self, writer, client, message, data):
+        """see :meth:`DiffusionServer._hold`"""
+        if self.snapshot is not None:
+            return
+        client.held.append((message, data))
+        client.held_bytes += len(data)
+        if client.held_bytes > self.max_queued_bytes:
+            log.warning("Client %r did not subscribe (%d bytes held), disconnecting"%(client.address,client.held_bytes))
+            self._remove(writer)
 
-    while server.is_alive():
+    def _on_control(self, writer, client, message):
+        """see :meth:`DiffusionServer._on_control`"""
+        control = _read_control(client, message)
+        now = time.time()
+        if control is None:
+            return
+        if control["cmd"] == "encoding":
+            reply = codec.dumpb(control)
+            if not self._queue(writer, client, client.encode(reply, frame(reply)), now):
+                return
+            if (control["encoding"], control["compression"]) != ("json", None):
+                client.encoder = diffusion_codec.StreamEncoder(control["encoding"], control["compression"])
+            log.info("Client %r switched to %r"%(client.address, control))
+            return
+        self.subscriptions.subscribe(client, Subscription.from_message(control))
+        client.subscribed = True
+        log.info("Client %r subscribed to %r"%(client.address, control))
+        if client.handshaking:
+            self._start(writer, client, control.get("resume"), now)
+
+    async def _write_loop(self, client):
+        writer = client.sock
         try:
-            text = raw_input(">")
-            server.check_and_raise()
-            client.check_and_raise()
-        except:
-            log.exception("Main exiting")
-            server.stop()
-            client.stop()
-            sys.exit(1)
-        server.send_message(text)
+            while True:
+                await client.ready.wait()
+                client.ready.clear()
+                now = time.time()
+                client.max_lag = max(client.max_lag, client.lag(now))
+                data = b"".join(item[1] for item in client.queue)
+                client.sent_messages += len(client.queue)
+                client.queue.clear()
+                client.queued_bytes = 0
+                writer.write(data)
+                client.sent_bytes += len(data)
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._remove(writer)
+
+    def _remove(self, writer):
+        client = self.active_connections.pop(writer, None)
+        if client is not None:
+            self.subscriptions.unsubscribe(client)
+            log.info("Removing connection to %r"%(client.address,))
+            if client.task is not None and client.task is not asyncio.current_task():
+                client.task.cancel()
+        writer.close()
+
+    def has_clients(self):
+        return len(self.active_connections) != 0
+
+    def client_stats(self):
+        """see :meth:`DiffusionServer.client_stats`"""
+        now = time.time()
+        return [client.stats(now) for client in self.active_connections.values()]
+
+    def is_started(self):
+        return self.server is not None and self.server.is_serving()
+
+    def is_alive(self):
+        return self.is_started()
+
+    def check_and_raise(self):
+        return True
+
+    def stop(self):
+        if self.server is not None:
+            self.server.close()
+        for writer in list(self.active_connections.keys()):
+            self._remove(writer)
+
+    async def wait_closed(self):
+        if self.server is not None:
+            await self.server.wait_closed()
+
+    def _queue(self, writer, client, data, now):
+        """queue a frame for ``client``, returns ``False`` if the client was disconnected"""
+        client.queue.append((now, data))
+        client.queued_bytes += len(data)
+        client.max_queued_bytes = max(client.max_queued_bytes, client.queued_bytes)
+        if client.queued_bytes > self.max_queued_bytes:
+            log.warning("Client %r is too slow (%d bytes queued), disconnecting"%(client.address,client.queued_bytes))
+            self.disconnected_slow_clients += 1
+            self._remove(writer)
+            return False
+        client.ready.set()
+        return True
+
+    def _queue_snapshot(self, writer, client, now):
+        """queue the snapshot for ``client``, returns ``False`` if the client was disconnected"""
+        for data in self.snapshot.frames(self.subscriptions.subscriptions.get(client)):
+            if not self._queue(writer, client, client.encode(data[FRAME_HEADER.size:], data), now):
+                return False
+        return True
+
+    def _queue_replay(self, writer, client, seq, now):
+        """see :meth:`DiffusionServer._queue_replay`"""
+        if seq is None or self.replay is None:
+            return False
+        messages = self.replay.since(seq)
+        if messages is None:
+            log.info("Client %r can't resume after seq %r, sending the snapshot"%(client.address, seq))
+            return False
+        subscription = self.subscriptions.subscriptions.get(client)
+        for message, data in messages:
+            if _wanted(subscription, message) and not self._queue(writer, client, client.encode(message, data), now):
+                break
+        log.info("Client %r resumed after seq %r, %d messages replayed"%(client.address, seq, len(messages)))
+        return True
+
+    def send_message(self,message):
+        now = time.time()
+        if self.replay is not None:
+            message, data = self.replay.stamp(message)
+        else:
+            data = frame(message)
+        packet = _decode(message, self.subscriptions, self.snapshot)
+        recipients = _recipients(self.subscriptions, packet)
+        for writer, client in list(self.active_connections.items()):
+            if writer.is_closing():
+                self._remove(writer)
+                continue
+            if client.handshaking:
+                self._hold(writer, client, message, data)
+                continue
+            if client.subscribed and client not in recipients:
+                continue
+            log.debug("Queuing [%s] to %r",message,client.address)
+            self._queue(writer, client, client.encode(message, data), now)
+        if packet is not None and self.snapshot is not None:
+            self.snapshot.update(packet)
+
+if __name__ == "__main__":
+    #load test, see bench.py for the options
+    import bench
+    bench.main(["load"] + sys.argv[1:])
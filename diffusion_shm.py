@@ -0,0 +1,251 @@
+""" Shared memory transport for the consumers running on the server host
+
+    :class:`SharedRing` is a single producer, multiple consumers ring buffer in a
+    :class:`multiprocessing.shared_memory.SharedMemory` block. The
+    :class:`diffusion_server.DiffusionServer` writes every message to it (see its
+    ``shm_name`` parameter) and any number of processes read it with a
+    :class:`SharedRingReader` or a :class:`SharedRingClient`, without any socket.
+
+    Readers are not known to the server: a reader never slows the server down, but a
+    reader that does not keep up loses the overwritten messages (see
+    :attr:`SharedRingReader.overruns`) instead of being disconnected. Readers start at
+    the current position (no snapshot, no subscription) and poll the write position.
+
+    Layout of the block: a header holding the write position (a byte count that only
+    grows, written twice so that a reader can detect a torn read), the write end (the
+    position the write in progress will reach, published before its bytes are copied,
+    also written twice) and the capacity, then the data area. Each message is stored as a 4 bytes length followed by the
+    message. A message never wraps around the end of the area: the end is skipped,
+    marked by a :data:`PADDING` length when there is room for it.
+"""
+import struct
+import threading
+import time
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    #python < 3.8
+    shared_memory = None
+
+import logging
+log = logging.getLogger(__name__)
+
+_QWORD = struct.Struct("=Q")
+_LENGTH = struct.Struct("=I")
+#header: write position, its copy, capacity, write end, its copy
+_POSITION_OFFSET = 0
+_POSITION_COPY_OFFSET = 8
+_CAPACITY_OFFSET = 16
+_WRITE_END_OFFSET = 24
+_WRITE_END_COPY_OFFSET = 32
+DATA_OFFSET = 64
+PADDING = 0xffffffff
+
+def _check_available():
+    if shared_memory is None:
+        raise ImportError("multiprocessing.shared_memory is not available (python >= 3.8 is required)")
+
+def _attach(name, **kwargs):
+    """open (or create) a shared memory block that the resource tracker does not destroy
+
+        the tracker of a process destroys its blocks when the process exits, and readers
+        started by the server process share its tracker. The block is destroyed by
+        :meth:`SharedRing.close`, or replaced when the next server starts.
+    """
+    try:
+        return shared_memory.SharedMemory(name = name, track = False, **kwargs)
+    except TypeError:
+        #python < 3.13
+        shm = shared_memory.SharedMemory(name = name, **kwargs)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        shm._untracked = True
+        return shm
+
+def _destroy(shm):
+    #before python 3.13, unlink() also unregisters the block from the tracker
+    if getattr(shm, "_untracked", False):
+        resource_tracker.register(shm._name, "shared_memory")
+    shm.unlink()
+
+class SharedRing:
+    """The writer of a shared memory ring
+
+        :param name: (str) name of the shared memory block, replaced if it already exists
+        :param size: (int) size of the data area in bytes, the largest message it accepts
+            is ``size - 4`` bytes
+    """
+    def __init__(self, name, size = 4 * 1024 * 1024):
+        _check_available()
+        try:
+            stale = _attach(name)
+        except FileNotFoundError:
+            pass
+        else:
+            log.warning("Replacing the existing shared memory %r"%name)
+            stale.close()
+            _destroy(stale)
+        self.shm = _attach(name, create = True, size = DATA_OFFSET + size)
+        self.name = name
+        self.buffer = self.shm.buf
+        self.capacity = size
+        self.position = 0
+        _QWORD.pack_into(self.buffer, _CAPACITY_OFFSET, size)
+        self._publish_write_end(0)
+        self._publish()
+
+    def _publish(self):
+        _QWORD.pack_into(self.buffer, _POSITION_OFFSET, self.position)
+        _QWORD.pack_into(self.buffer, _POSITION_COPY_OFFSET, self.position)
+
+    def _publish_write_end(self, write_end):
+        _QWORD.pack_into(self.buffer, _WRITE_END_OFFSET, write_end)
+        _QWORD.pack_into(self.buffer, _WRITE_END_COPY_OFFSET, write_end)
+
+    def write(self, message):
+        """append ``message`` (``bytes``), it overwrites the oldest messages
+
+            :raises: :exc:`ValueError` (``message`` larger than the ring)
+        """
+        needed = _LENGTH.size + len(message)
+        if needed > self.capacity:
+            raise ValueError("Message too large for the ring (%d bytes)"%len(message))
+        offset = self.position % self.capacity
+        skipped = self.capacity - offset if self.capacity - offset < needed else 0
+        #readers must know which bytes are about to be overwritten before they are
+        self._publish_write_end(self.position + skipped + needed)
+        if skipped:
+            if skipped >= _LENGTH.size:
+                _LENGTH.pack_into(self.buffer, DATA_OFFSET + offset, PADDING)
+            self.position += skipped
+            offset = 0
+        start = DATA_OFFSET + offset
+        _LENGTH.pack_into(self.buffer, start, len(message))
+        self.buffer[start + _LENGTH.size:start + needed] = message
+        self.position += needed
+        self._publish()
+
+    def close(self):
+        """release and destroy the shared memory block"""
+        self.buffer = None
+        self.shm.close()
+        try:
+            _destroy(self.shm)
+        except FileNotFoundError:
+            pass
+
+class SharedRingReader:
+    """A reader of a :class:`SharedRing`, created by another process
+
+        :param name: (str) name of the shared memory block
+    """
+    def __init__(self, name):
+        _check_available()
+        self.shm = _attach(name)
+        self.buffer = self.shm.buf
+        self.capacity = _QWORD.unpack_from(self.buffer, _CAPACITY_OFFSET)[0]
+        self.position = self._write_position()
+        self.overruns = 0
+        self.lost_bytes = 0
+
+    def _write_position(self):
+        return self._read_qword(_POSITION_OFFSET, _POSITION_COPY_OFFSET)
+
+    def _write_end(self):
+        return self._read_qword(_WRITE_END_OFFSET, _WRITE_END_COPY_OFFSET)
+
+    def _read_qword(self, offset, copy_offset):
+        while True:
+            copy = _QWORD.unpack_from(self.buffer, copy_offset)[0]
+            value = _QWORD.unpack_from(self.buffer, offset)[0]
+            if value == copy:
+                return value
+
+    def _resync(self, end):
+        self.overruns += 1
+        self.lost_bytes += end - self.position
+        log.warning("Shared ring reader overrun, %d bytes lost"%(end - self.position))
+        self.position = end
+
+    def read(self):
+        """returns the list of messages (``bytes``) written since the last call"""
+        end = self._write_position()
+        if end - self.position > self.capacity:
+            self._resync(end)
+            return []
+        start = self.position
+        position = start
+        messages = []
+        buffer = self.buffer
+        capacity = self.capacity
+        while position < end:
+            offset = position % capacity
+            if capacity - offset < _LENGTH.size:
+                position += capacity - offset
+                continue
+            length = _LENGTH.unpack_from(buffer, DATA_OFFSET + offset)[0]
+            if length == PADDING:
+                position += capacity - offset
+                continue
+            if position + _LENGTH.size + length > end:
+                #overwritten length, detected below
+                break
+            data_start = DATA_OFFSET + offset + _LENGTH.size
+            messages.append(bytes(buffer[data_start:data_start + length]))
+            position += _LENGTH.size + length
+        #the writer may have overwritten what was just read, or be overwriting it
+        if self._write_end() - start > capacity or position != end:
+            self._resync(self._write_position())
+            return []
+        self.position = position
+        return messages
+
+    def close(self):
+        self.buffer = None
+        self.shm.close()
+
+class SharedRingClient:
+    """Receive the messages of a :class:`SharedRing` in a dedicated thread
+
+        :param callback: a function ``cb(message, "shared_memory")`` called once per message
+        :param name: (str) name of the shared memory block
+        :param poll_interval: (float) sleep in seconds when the ring is empty. A shorter
+            interval lowers the latency and costs more CPU while idle
+
+        same interface as :class:`diffusion_server.DiffusionClient`
+    """
+    def __init__(self, callback, name, poll_interval = 0.0005):
+        self.callback = callback
+        self.poll_interval = poll_interval
+        self.reader = SharedRingReader(name)
+        self.stop_event = threading.Event()
+        self.client_thread = threading.Thread(target = self._run, name = "shm_client_thread")
+        self.client_thread.daemon = True
+        self.client_thread.start()
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            messages = self.reader.read()
+            if not messages:
+                time.sleep(self.poll_interval)
+                continue
+            for message in messages:
+                try:
+                    self.callback(message, "shared_memory")
+                except Exception as e:
+                    log.error("Error while receiving: %s"%str(e))
+                    log.exception("receiving")
+        self.reader.close()
+
+    def __enter__(self):
+        return self
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.stop()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def is_alive(self):
+        return not self.stop_event.is_set()
+
+    def check_and_raise(self):
+        return True
@@ -1,4 +1,5 @@
 import aqara
+from reactor import Reactor
 import json
 import logging
 logging.getLogger(__name__)
@@ -10,12 +11,9 @@ root = AD.AqaraRoot()
 def handle_packet(address,kind,data):
     root.handle_packet(data)
 
-connector = aqara.AquaraConnector(start_server=True,data_callback=handle_packet)
+connector = aqara.AquaraConnector(start_server=True,data_callback=handle_packet,reactor=Reactor())
 
-import time
 with connector:
-    while(True):
-        #print("checking data")
-        connector.check_incoming()
+    connector.run_forever()
 
 
@@ -0,0 +1,167 @@
+""" Single threaded event loop for the aqara sockets """
+import selectors
+import socket
+import heapq
+import itertools
+import collections
+import threading
+import time
+import logging
+log = logging.getLogger(__name__)
+
+EVENT_READ = selectors.EVENT_READ
+EVENT_WRITE = selectors.EVENT_WRITE
+
+class Reactor:
+    """A :mod:`selectors` based reactor
+
+        Sockets are registered with a callback of the form ``cb(fileobj, mask)``
+        that is called whenever the socket is ready. The loop sleeps in the
+        selector until a socket is ready: there is no periodic wakeup.
+
+        :meth:`call_soon`, :meth:`call_later` and :meth:`stop` can be called from any thread,
+        every other method must be called from the thread that runs the loop
+        (or before the loop is started).
+    """
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self._pending = collections.deque()
+        self._timers = []  #heap of (deadline, sequence, function, args)
+        self._timers_lock = threading.Lock()
+        self._timer_sequence = itertools.count()
+        self._stop_requested = False
+        self._thread_id = None
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        self.selector.register(self._wakeup_recv, EVENT_READ, self._on_wakeup)
+
+    def register(self, fileobj, callback, events=EVENT_READ):
+        """Register ``fileobj`` for ``events``
+
+            :param fileobj: a socket (or any object with a ``fileno()`` method)
+            :param callback: a function ``cb(fileobj, mask)``
+            :param events: a mask of :data:`EVENT_READ` and :data:`EVENT_WRITE`
+        """
+        self.selector.register(fileobj, events, callback)
+
+    def modify(self, fileobj, callback, events=EVENT_READ):
+        """Change the events and callback of an already registered ``fileobj``"""
+        self.selector.modify(fileobj, events, callback)
+
+    def unregister(self, fileobj):
+        """Stop watching ``fileobj``, does nothing if it is not registered"""
+        try:
+            self.selector.unregister(fileobj)
+        except (KeyError, ValueError):
+            pass
+
+    def is_registered(self, fileobj):
+        try:
+            self.selector.get_key(fileobj)
+            return True
+        except (KeyError, ValueError):
+            return False
+
+    def in_loop_thread(self):
+        """``True`` if the caller runs inside :meth:`run_forever`"""
+        return self._thread_id == threading.get_ident()
+
+    def call_soon(self, function, *args):
+        """Run ``function(*args)`` from the loop thread (thread safe)"""
+        self._pending.append((function, args))
+        if not self.in_loop_thread():
+            #the loop runs the pending calls before it sleeps again, no wakeup needed from its thread
+            self._wakeup()
+
+    def call_later(self, delay, function, *args):
+        """Run ``function(*args)`` from the loop thread in ``delay`` seconds (thread safe)"""
+        with self._timers_lock:
+            heapq.heappush(self._timers, (time.monotonic() + delay, next(self._timer_sequence), function, args))
+        if not self.in_loop_thread():
+            self._wakeup()
+
+    def stop(self):
+        """Make :meth:`run_forever` return (thread safe)"""
+        self._stop_requested = True
+        self._wakeup()
+
+    def _wakeup(self):
+        try:
+            self._wakeup_send.send(b"\0")
+        except (BlockingIOError, OSError):
+            #the wakeup socket is already full (or closed): the loop will wake up anyway
+            pass
+
+    def _on_wakeup(self, fileobj, mask):
+        try:
+            while self._wakeup_recv.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def _run_pending(self):
+        while self._pending:
+            function, args = self._pending.popleft()
+            try:
+                function(*args)
+            except Exception:
+                log.exception("Reactor: error in %r"%function)
+
+    def _run_timers(self):
+        """run the expired timers, returns the delay until the next one (``None`` if there is none)"""
+        now = time.monotonic()
+        while True:
+            with self._timers_lock:
+                if not self._timers:
+                    return None
+                if self._timers[0][0] > now:
+                    return self._timers[0][0] - now
+                deadline, sequence, function, args = heapq.heappop(self._timers)
+            try:
+                function(*args)
+            except Exception:
+                log.exception("Reactor: error in %r"%function)
+
+    def run_once(self, timeout=None):
+        """Wait at most ``timeout`` seconds (``None``: forever) for events and dispatch them"""
+        self._run_pending()
+        next_timer = self._run_timers()
+        if self._pending:
+            timeout = 0
+        elif next_timer is not None and (timeout is None or next_timer < timeout):
+            timeout = next_timer
+        for key, mask in self.selector.select(timeout):
+            try:
+                key.data(key.fileobj, mask)
+            except Exception:
+                log.exception("Reactor: error while handling %r"%key.fileobj)
+        self._run_pending()
+        self._run_timers()
+
+    def run_forever(self, timeout=None):
+        """Dispatch events until :meth:`stop` is called
+
+            :param timeout: (opt) return after ``timeout`` seconds even if
+                :meth:`stop` was not called. ``None`` runs until stopped.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        self._stop_requested = False
+        self._thread_id = threading.get_ident()
+        try:
+            while not self._stop_requested:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                self.run_once(remaining)
+        finally:
+            self._thread_id = None
+
+    def close(self):
+        self.selector.close()
+        self._wakeup_recv.close()
+        self._wakeup_send.close()
@@ -1,7 +1,9 @@
 # -*- coding: utf8 -*-
+import sys
 import aqara
 import aqara_devices as AD
-import json
+from reactor import Reactor
+import aqara_codec as codec
 record_file = "event_recording.log"
 import logging
 log=logging.getLogger(__name__)
@@ -13,21 +15,18 @@ def logit(address,devicetype,data):
     print(data)
     data["_ts_"] = time.time()
     with open ( record_file,"a") as logfile:
-        logfile.write(json.dumps(data) + "\n")
+        logfile.write(codec.dumps(data) + "\n")
 
 def record():
     print("Attaching to Aqara Connector")
-    connector = aqara.AquaraConnector(data_callback=logit)
+    connector = aqara.AquaraConnector(data_callback=logit, reactor=Reactor())
     print("Starting listening loop")
     with connector:
-        while(True):
-            try:
-                connector.check_incoming()
-            except KeyboardInterrupt:
-                connector.stop()
-                sys.exit(0)
-            except:
-                log.error("Exception, retrying")
+        try:
+            connector.run_forever()
+        except KeyboardInterrupt:
+            connector.stop()
+            sys.exit(0)
 
 def on_new_temp(data):
     log.info("new_temp [%s/%s]: %.2f"%(data["source_device"].context.get("room",""), data["source_device"].context.get("room",""), data["value"]))
@@ -68,7 +67,7 @@ def replay(speed=5):
 
     last_time = 0.
     for i,line in enumerate(lines):
-        data = json.loads(line)
+        data = codec.loads(line)
 
         #if speed is not none, replay with timestamps
         ts = data.get("_ts_")
@@ -81,7 +80,7 @@ def replay(speed=5):
                 time.sleep((ts - last_time)/speed)
             last_time = ts
 
-        root.handle_packet(line)
+        root.handle_packet(data)
 
     return
     for model in root.dev_by_model.keys():
@@ -117,7 +116,6 @@ if __name__ == "__main__":
 
     if (args.replay and args.record):
         print("Error, choose only one option")
-        import sys
         sys.exit(1)
     if (args.replay):
         replay()
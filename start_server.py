@@ -1,4 +1,6 @@
 import aqara
+import aqara_workers
+from reactor import Reactor
 import logging
 log=logging.getLogger(__name__)
 
@@ -6,6 +8,10 @@ import argparse
 
 parser = argparse.ArgumentParser(description='Aqara tcp hub server')
 parser.add_argument("--log", help='destination log file')
+parser.add_argument("--workers", type=int, default=0,
+                    help='handle packets in WORKERS processes, each device always goes to the same worker (default: no worker)')
+parser.add_argument("--worker-init", default=None,
+                    help='module:function called as function(root, worker_index) in each worker')
 
 args = parser.parse_args()
 if args.log is not None:
@@ -16,10 +22,16 @@ if args.log is not None:
 else:
     logging.basicConfig(level=logging.INFO)
 
+data_callback = None
+dispatcher = None
+if args.workers > 0:
+    dispatcher = aqara_workers.ShardedDispatcher(workers=args.workers, worker_init=args.worker_init).start()
+    data_callback = dispatcher.data_callback
+
 for i in range(10):
     try:
         log.info("Starting server (retry %d)"%i)
-        connector = aqara.AquaraConnector(start_server=True)
+        connector = aqara.AquaraConnector(start_server=True, data_callback=data_callback, reactor=Reactor())
         break;
     except:
         log.exception("failed starting server")
@@ -29,9 +41,9 @@ for i in range(10):
 #Server hopefull started
 try:
     with connector:
-        while(True):
-            connector.check_incoming()
+        connector.run_forever()
 except:
-    log.exception()
-
-
+    log.exception("server loop")
+finally:
+    if dispatcher is not None:
+        dispatcher.stop()
@@ -0,0 +1,173 @@
+import json
+import socket
+import unittest
+
+import diffusion_server as DS
+from reactor import Reactor
+
+class _PartialSocket(object):
+    """A client socket that accepts ``accept`` bytes per send"""
+    def __init__(self, accept):
+        self.accept = accept
+        self.received = bytearray()
+        self.pair = socket.socketpair()
+
+    def fileno(self):
+        return self.pair[0].fileno()
+
+    def send(self, data):
+        sent = min(self.accept, len(data))
+        self.received += data[:sent]
+        return sent
+
+    def close(self):
+        for sock in self.pair:
+            sock.close()
+
+class _PublishingSocket(_PartialSocket):
+    """A client socket that calls ``on_send`` (once) before accepting the bytes of a send"""
+    def __init__(self, accept, on_send):
+        _PartialSocket.__init__(self, accept)
+        self.on_send = on_send
+
+    def send(self, data):
+        on_send, self.on_send = self.on_send, None
+        if on_send is not None:
+            on_send()
+        return _PartialSocket.send(self, data)
+
+def _packet(sid, value, capability="temperature"):
+    return json.dumps({"cmd": "report", "model": "weather.v2", "sid": sid,
+                       "data": json.dumps({capability: str(value)})}).encode()
+
+class CoalesceTest(unittest.TestCase):
+    def setUp(self):
+        self.reactor = Reactor()
+        self.server = DS.DiffusionServer(("127.0.0.1", 0), reactor=self.reactor, max_queued_bytes=2000,
+                                          slow_client_policy="coalesce", snapshot=False)
+        self.sock = _PartialSocket(10)
+        self.client = DS._ClientConnection(self.sock, ("fake", 0))
+        self.client.handshaking = False
+        self.server.active_connections[self.sock] = self.client
+        self.reactor.register(self.sock, self.server._on_client_event)
+
+    def tearDown(self):
+        self.server._close()
+        self.reactor.close()
+        self.sock.close()
+
+    def test_partially_sent_head_is_not_coalesced(self):
+        self.server.send_message(_packet("158d0001", 0))
+        self.server._flush(self.sock)
+        self.assertEqual(self.client.head_offset, 10)
+        #newer messages of the same (sid, cmd) overflow the queue and get coalesced
+        for value in range(1, 40):
+            self.server.send_message(_packet("158d0001", value))
+        self.assertGreater(self.client.coalesced_messages, 0)
+        self.assertIn(self.sock, self.server.active_connections)
+        self.sock.accept = 1 << 20
+        while self.client.queue:
+            self.server._flush(self.sock)
+        self.assertEqual(self.client.queued_bytes, 0)
+
+        messages = DS.FrameReader().feed(bytes(self.sock.received))
+        values = [json.loads(json.loads(message)["data"])["temperature"] for message in messages]
+        self.assertEqual(values[0], "0")
+        self.assertEqual(values[-1], "39")
+
+    def test_messages_being_sent_are_not_coalesced(self):
+        self.server.send_message(_packet("158d0001", 0))
+        self.server.send_message(_packet("158d0001", 1))
+        #another thread publishes while the reactor sends the queue
+        sock = _PublishingSocket(150, lambda: [self.server.send_message(_packet("158d0001", value))
+                                               for value in range(2, 42)])
+        client = DS._ClientConnection(sock, ("fake", 1))
+        client.handshaking = False
+        client.queue, client.queued_bytes = self.client.queue, self.client.queued_bytes
+        del self.server.active_connections[self.sock]
+        self.server.active_connections[sock] = client
+        self.reactor.register(sock, self.server._on_client_event)
+        self.addCleanup(sock.close)
+        self.server._flush(sock)
+        self.assertGreater(client.coalesced_messages, 0)
+        sock.accept = 1 << 20
+        while client.queue:
+            self.server._flush(sock)
+
+        messages = DS.FrameReader().feed(bytes(sock.received))
+        values = [json.loads(json.loads(message)["data"])["temperature"] for message in messages]
+        self.assertEqual(values[:2], ["0", "1"])
+        self.assertEqual(values[-1], "41")
+
+    def test_capabilities_are_coalesced_separately(self):
+        for value in range(30):
+            for capability in ("temperature", "humidity", "pressure"):
+                self.server.send_message(_packet("158d0001", value, capability))
+        self.assertGreater(self.client.coalesced_messages, 0)
+        self.client.coalesce()
+
+        messages = [json.loads(item[1][DS.FRAME_HEADER.size:]) for item in self.client.queue]
+        self.assertEqual([json.loads(message["data"]) for message in messages],
+                         [{"temperature": "29"}, {"humidity": "29"}, {"pressure": "29"}])
+
+    def test_snapshot_is_not_replaced_by_a_single_capability(self):
+        self.server.snapshot = DS.StateSnapshot()
+        self.server.snapshot.update({"cmd": "report", "sid": "158d0001", "data": {"humidity": "4512"}})
+        self.server.snapshot.update({"cmd": "report", "sid": "158d0001", "data": {"pressure": "98755"}})
+        with self.server.connections_lock:
+            self.server._queue_snapshot(self.sock, self.client, 0.)
+        for value in range(40):
+            self.server.send_message(_packet("158d0001", value))
+        self.assertGreater(self.client.coalesced_messages, 0)
+        self.sock.accept = 1 << 20
+        while self.client.queue:
+            self.server._flush(self.sock)
+
+        messages = [json.loads(message) for message in DS.FrameReader().feed(bytes(self.sock.received))]
+        self.assertTrue(messages[0]["snapshot"])
+        self.assertEqual(json.loads(messages[0]["data"]), {"humidity": "4512", "pressure": "98755"})
+        self.assertEqual(json.loads(messages[-1]["data"]), {"temperature": "39"})
+
+class HandshakeTest(unittest.TestCase):
+    def setUp(self):
+        self.reactor = Reactor()
+        self.server = DS.DiffusionServer(("127.0.0.1", 0), reactor=self.reactor)
+        self.sockets = []
+
+    def tearDown(self):
+        self.server._close()
+        self.reactor.close()
+        for sock in self.sockets:
+            sock.close()
+
+    def _connect(self):
+        sock = _PartialSocket(1 << 20)
+        self.sockets.append(sock)
+        client = DS._ClientConnection(sock, ("fake", len(self.sockets)))
+        self.server.active_connections[sock] = client
+        self.reactor.register(sock, self.server._on_client_event)
+        return sock, client
+
+    def _received(self, sock):
+        self.server._flush(sock)
+        return [json.loads(message) for message in DS.FrameReader().feed(bytes(sock.received))]
+
+    def test_resume_replays_messages_sent_before_the_subscription(self):
+        sock, client = self._connect()
+        self.server._on_control(sock, client, b'{"cmd": "subscribe"}')
+        self.server.send_message(_packet("158d0001", 0))
+        last_seq = self._received(sock)[-1]["seq"]
+
+        #reconnection: messages are sent before the server reads the subscription
+        sock, client = self._connect()
+        self.server.send_message(_packet("158d0001", 1))
+        self.server.send_message(_packet("158d0002", 2))
+        self.assertEqual(len(client.queue), 0)
+        self.server._on_control(sock, client, json.dumps({"cmd": "subscribe", "sids": ["158d0002"],
+                                                          "resume": last_seq}).encode())
+        messages = self._received(sock)
+        self.assertEqual([message["sid"] for message in messages], ["158d0002"])
+        self.assertFalse(messages[0].get("snapshot", False))
+
+if __name__ == "__main__":
+    unittest.main()
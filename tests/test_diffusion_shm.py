@@ -0,0 +1,39 @@
+import os
+import unittest
+
+import diffusion_shm
+
+@unittest.skipIf(diffusion_shm.shared_memory is None, "multiprocessing.shared_memory is not available")
+class SharedRingTest(unittest.TestCase):
+    def setUp(self):
+        self.ring = diffusion_shm.SharedRing("test_ring_%d"%os.getpid(), 1000)
+        self.reader = diffusion_shm.SharedRingReader(self.ring.name)
+
+    def tearDown(self):
+        self.reader.close()
+        self.ring.close()
+
+    def test_read(self):
+        messages = [b"message %d"%i for i in range(300)]
+        received = []
+        for message in messages:
+            self.ring.write(message)
+            received += self.reader.read()
+        self.assertEqual(received, messages)
+        self.assertEqual(self.reader.overruns, 0)
+
+    def test_write_in_progress_is_an_overrun(self):
+        #the reader lags by less than the capacity
+        for i in range(18):
+            self.ring.write(b"%048d"%i)
+        self.assertLess(self.ring.position - self.reader.position, self.ring.capacity)
+        #a write that overwrites the oldest unread bytes, seen before its position is published
+        published = self.ring.position
+        self.ring.write(b"x" * 100)
+        self.ring.position = published
+        self.ring._publish()
+        self.assertEqual(self.reader.read(), [])
+        self.assertEqual(self.reader.overruns, 1)
+
+if __name__ == "__main__":
+    unittest.main()
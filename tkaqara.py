@@ -274,13 +274,8 @@ if __name__ == '__main__':
 
     def listen():
         def handle_packet(msg,who):
-            msg = msg.decode("utf-8")
-            #log.warning("new message : %s"%msg)
-            #maybe several packets
-            msgs = msg.split('{"cmd"')
-            for data in msgs[1:]:
-                #log.warning(data)
-                tkroot.update('{"cmd"'+ data)
+            #one complete packet per call
+            tkroot.update(msg.decode("utf-8"))
         print("Attaching to Aqara Connector")
         import diffusion_server as ds
         connector = ds.DiffusionClient(handle_packet,"192.168.0.201")